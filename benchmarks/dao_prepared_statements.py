@@ -0,0 +1,42 @@
+"""
+比较热点 DAO 查询使用预备语句与普通查询的耗时。需要可用的 PostgreSQL 和 Redis。
+
+运行：MODE=DEVELOPMENT python -m benchmarks.dao_prepared_statements
+"""
+import timeit
+
+from everyclass.server.config import get_config
+from everyclass.server.db.dao import CalendarToken, PrivacySettings, User
+from everyclass.server.db.postgres import init_pool
+from everyclass.server.db.redis import redis
+
+ROUNDS = 2000
+STUDENT_ID = "3901160407"
+TOKEN = "00000000-0000-0000-0000-000000000000"
+
+
+def privacy_level():
+    redis.delete("ec_sv:privacy:{}".format(STUDENT_ID))  # 绕过缓存，测量数据库查询
+    PrivacySettings.get_level(STUDENT_ID)
+
+
+CASES = {"find_calendar_token": lambda: CalendarToken.find_calendar_token(token=TOKEN),
+         "get_level"          : privacy_level,
+         "user_exist"         : lambda: User.exist(STUDENT_ID)}
+
+
+def main():
+    init_pool()
+    config = get_config()
+    for name, func in CASES.items():
+        results = {}
+        for prepared in (False, True):
+            config.POSTGRES_PREPARED_STATEMENTS = prepared
+            func()  # warm up (and PREPARE)
+            results[prepared] = timeit.timeit(func, number=ROUNDS) / ROUNDS * 1e6
+        print("{:<20} plain: {:8.1f} us   prepared: {:8.1f} us   ({:+.1f}%)".format(
+                name, results[False], results[True], (results[True] - results[False]) / results[False] * 100))
+
+
+if __name__ == '__main__':
+    main()
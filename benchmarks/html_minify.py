@@ -0,0 +1,37 @@
+"""
+对比两种 HTML 压缩方式的开销：每个响应运行 htmlmin（旧），与模板编译时压缩一次（新）。
+
+以 `query/student.html` 及其父模板 `layout.html` 的源码作为页面样本。新方式在模板第一次加载时压缩一次，之后每次渲染没有额外开销。
+
+运行：python -m benchmarks.html_minify
+"""
+import os
+import timeit
+
+from htmlmin import minify
+
+from everyclass.server.utils.jinja import minify_html
+
+ROUNDS = 200
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), '../frontend/templates')
+
+
+def main():
+    page = ""
+    for name in ("layout.html", "query/student.html"):
+        with open(os.path.join(TEMPLATE_DIR, name), encoding='utf-8') as f:
+            page += f.read()
+
+    runtime = timeit.timeit(lambda: minify(page), number=ROUNDS) / ROUNDS * 1000
+    compile_time = timeit.timeit(lambda: minify_html(page), number=ROUNDS) / ROUNDS * 1000
+
+    print("page size:                    {:8d} B".format(len(page)))
+    print("htmlmin size:                 {:8d} B".format(len(minify(page))))
+    print("template-time minified size:  {:8d} B".format(len(minify_html(page))))
+    print("htmlmin per response:         {:8.3f} ms".format(runtime))
+    print("template minify (once):       {:8.3f} ms".format(compile_time))
+    print("template minify per response: {:8.3f} ms".format(0))
+
+
+if __name__ == '__main__':
+    main()
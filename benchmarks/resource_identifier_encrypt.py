@@ -0,0 +1,44 @@
+"""
+测量资源标识符每次加密、解密的耗时：不使用缓存（每次新建 AES 对象）与使用缓存（缓存命中）的对比。
+
+运行：python -m benchmarks.resource_identifier_encrypt
+"""
+import timeit
+
+from everyclass.server.utils import resource_identifier_encrypt as rie
+
+ROUNDS = 100000
+KEY = "z094gikTit;5gt5h"
+IDS = ["39011604{:02d}".format(i) for i in range(100)]
+
+
+def main():
+    encrypted = rie.encrypt_many("student", IDS, encryption_key=KEY)
+
+    def uncached_encrypt():
+        # 与优化前相同：每次新建 AES 对象
+        rie._cipher.cache_clear()
+        rie._aes_encrypt(KEY, "student;" + IDS[0])
+
+    def uncached_decrypt():
+        rie._cipher.cache_clear()
+        rie._RESOURCE_PATTERN.match(rie._aes_decrypt(KEY, encrypted[0]))
+
+    results = {
+        "encrypt (new cipher)" : timeit.timeit(uncached_encrypt, number=ROUNDS),
+        "decrypt (new cipher)" : timeit.timeit(uncached_decrypt, number=ROUNDS),
+        "encrypt (cached)"     : timeit.timeit(lambda: rie.encrypt("student", IDS[0], encryption_key=KEY),
+                                               number=ROUNDS),
+        "decrypt (cached)"     : timeit.timeit(lambda: rie.decrypt(encrypted[0], encryption_key=KEY),
+                                               number=ROUNDS),
+        "encrypt_many (per id)": timeit.timeit(lambda: rie.encrypt_many("student", IDS, encryption_key=KEY),
+                                               number=ROUNDS // len(IDS)),
+        "decrypt_many (per id)": timeit.timeit(lambda: rie.decrypt_many(encrypted, encryption_key=KEY),
+                                               number=ROUNDS // len(IDS)),
+    }
+    for name, total in results.items():
+        print("{:24s}{:8.2f} us/id".format(name, total / ROUNDS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
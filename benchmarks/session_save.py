@@ -0,0 +1,49 @@
+"""
+测量 `EncryptedSessionInterface.save_session` 在 session 已修改和未修改时每个请求的 CPU 耗时。
+
+运行：python -m benchmarks.session_save
+"""
+import timeit
+
+from flask import Flask
+
+from everyclass.server.consts import SESSION_CURRENT_USER, SESSION_LAST_VIEWED_STUDENT
+from everyclass.server.models import StudentSession
+from everyclass.server.utils.session import EncryptedSessionInterface
+
+ROUNDS = 20000
+
+
+def main():
+    app = Flask(__name__)
+    app.config['SESSION_CRYPTO_KEY'] = b'\xcb\xf2\x19H\xd9l\x05\xc7j\xb2\xd0^}B*\x8d\xb6\x8aPd\x1c%\x83\x1e_\xf0\xb9C\xa9XOC'
+    app.config['SESSION_COOKIE_REFRESH_INTERVAL'] = 60 * 60 * 24
+    interface = EncryptedSessionInterface()
+    student = StudentSession(sid_orig="3901160407", sid="8ypVY3OsRhbXuGBXNpY5PEgmh53TmMfONVoRqfJ7fXY=", name="张三")
+
+    with app.test_request_context():
+        # 模拟一个已经下发过 cookie 的登录用户
+        response = app.response_class()
+        session = interface.session_class({"user_id"                  : 10000001,
+                                           SESSION_CURRENT_USER       : student,
+                                           SESSION_LAST_VIEWED_STUDENT: student})
+        interface.save_session(app, session, response)
+
+        def save_modified():
+            session.modified = True
+            interface.save_session(app, session, app.response_class())
+
+        def save_unmodified():
+            session.modified = False
+            interface.save_session(app, session, app.response_class())
+
+        modified = timeit.timeit(save_modified, number=ROUNDS) / ROUNDS * 1e6
+        unmodified = timeit.timeit(save_unmodified, number=ROUNDS) / ROUNDS * 1e6
+
+    print("save_session modified:   {:8.1f} us/request".format(modified))
+    print("save_session unmodified: {:8.1f} us/request".format(unmodified))
+    print("saved:                   {:8.1f} us/request".format(modified - unmodified))
+
+
+if __name__ == '__main__':
+    main()
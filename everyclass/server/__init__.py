@@ -11,17 +11,22 @@ from htmlmin import minify
 from raven.contrib.flask import Sentry
 from raven.handlers.logging import SentryHandler
 
+from everyclass.server.config import get_config
 from everyclass.server.utils import plugin_available
-from everyclass.server.utils.session import EncryptedSessionInterface
+from everyclass.server.utils.jinja import HTMLMinifyExtension
+from everyclass.server.utils.session import EncryptedSessionInterface, RedisSessionInterface
 
 logger = logging.getLogger(__name__)
 sentry = Sentry()
 statsd = None
+uwsgi_available = False  # 是否在 uWSGI 中运行（定时任务是否可用）
 __app = None
 
 try:
     import uwsgidecorators
 
+    uwsgi_available = True
+
     """
     使用 `uwsgidecorators.postfork` 装饰的函数会在 fork() 后的**每一个**子进程内被执行，执行顺序与这里的定义顺序一致
     """
@@ -60,9 +65,26 @@ try:
     def init_db():
         """初始化数据库连接"""
         from everyclass.server.db.postgres import init_pool as init_pg
+        from everyclass.server.db.mongodb import reset_client as reset_mongo_client
+        from everyclass.server.db.dao import UserIdSequence
 
-        # init_mongo(__app)
         init_pg()
+        reset_mongo_client()
+        UserIdSequence.reset()
+
+    @uwsgidecorators.postfork
+    def init_password_executor():
+        """创建密码哈希线程池"""
+        from everyclass.server.utils import password
+
+        password.init_executor()
+
+    @uwsgidecorators.postfork
+    def build_weak_password_filter():
+        """生成弱密码布隆过滤器，此后每隔 WEAK_PASSWORD_FILTER_REFRESH 秒由定时任务重新生成"""
+        from everyclass.server.utils import password_strength
+
+        password_strength.build_weak_passwords()
 
     @uwsgidecorators.postfork
     def fetch_remote_manifests():
@@ -77,6 +99,38 @@ try:
         """每天凌晨更新数据最后更新时间"""
         cron_update_remote_manifest()
 
+    @uwsgidecorators.cron(30, -1, -1, -1, -1)
+    def hourly_build_course_review_leaderboard(signum):
+        """每小时重新生成课程评价排行榜"""
+        from everyclass.server.db.dao import CourseReviewLeaderboard
+
+        if get_config().FEATURE_GATING['course_review']:
+            CourseReviewLeaderboard.build()
+
+    @uwsgidecorators.cron(0, get_config().RETENTION_HOUR, -1, -1, -1)
+    def daily_purge_expired_data(signum):
+        """每天低峰期清理过期数据"""
+        from everyclass.server.db import retention
+
+        with __app.app_context():
+            retention.run()
+
+    @uwsgidecorators.timer(get_config().WEAK_PASSWORD_FILTER_REFRESH, target="workers")
+    def refresh_weak_password_filter(signum):
+        """定期重新生成弱密码布隆过滤器（每个 worker 各自的内存中都有一份）"""
+        from everyclass.server.utils import password_strength
+
+        password_strength.build_weak_passwords()
+
+    @uwsgidecorators.timer(get_config().VISIT_TRACK_FLUSH_INTERVAL)
+    def flush_visit_tracks(signum):
+        """将 Redis 队列中的访客记录批量写入数据库"""
+        from everyclass.server.db.dao import VisitTrack
+
+        count = VisitTrack.flush_queue()
+        if count:
+            logger.info(f"Flushed {count} visit tracks to database.")
+
 except ModuleNotFoundError:
     pass
 
@@ -150,8 +204,11 @@ def create_app() -> Flask:
     # moment
     Moment(app)
 
-    # encrypted session
-    app.session_interface = EncryptedSessionInterface()
+    # session
+    if app.config['SESSION_STORE'] == "redis":
+        app.session_interface = RedisSessionInterface()
+    else:
+        app.session_interface = EncryptedSessionInterface()
 
     # 导入并注册 blueprints
     from everyclass.server.calendar.views import cal_blueprint
@@ -159,10 +216,12 @@ def create_app() -> Flask:
     from everyclass.server.views import main_blueprint as main_blueprint
     from everyclass.server.user.views import user_bp
     from everyclass.server.course_review.views import cr_blueprint
+    from everyclass.server.api.views import api_v1
     app.register_blueprint(cal_blueprint)
     app.register_blueprint(query_blueprint)
     app.register_blueprint(main_blueprint)
     app.register_blueprint(user_bp, url_prefix='/user')
+    app.register_blueprint(api_v1, url_prefix='/api/v1')
 
     # 初始化 RPC 模块
     from everyclass.server.utils.resource_identifier_encrypt import encrypt
@@ -186,7 +245,10 @@ def create_app() -> Flask:
         """在请求之前设置 session uid，方便 APM 标识用户"""
         from everyclass.server.consts import SESSION_CURRENT_USER
 
-        if not session.get('user_id', None) and request.endpoint not in ("main.health_check", "static"):
+        if request.endpoint in ("main.health_check", "static") or request.blueprint in ("calendar", "api_v1"):
+            return  # 不读取 session，服务端 session 模式下不访问 Redis。日历订阅和 API 客户端也不需要分配用户 ID
+
+        if not session.get('user_id', None) and not app.config['LAZY_USER_ID']:
             logger.info(f"Give a new user ID for new user. endpoint: {request.endpoint}")
             session['user_id'] = new_user_id_sequence()
         if session.get('user_id', None):
@@ -206,10 +268,14 @@ def create_app() -> Flask:
             session.clear()
             return redirect(request.url)
 
+    # 在模板编译时压缩 HTML，减轻带宽压力
+    if app.config['HTML_MINIFY']:
+        app.jinja_env.add_extension(HTMLMinifyExtension)
+
     @app.after_request
     def response_minify(response):
-        """用 htmlmin 压缩 HTML，减轻带宽压力"""
-        if app.config['HTML_MINIFY'] and response.content_type == u'text/html; charset=utf-8':
+        """用 htmlmin 压缩每个 HTML 响应。开销较大，默认关闭"""
+        if app.config['HTML_MINIFY_RUNTIME'] and response.content_type == u'text/html; charset=utf-8':
             response.set_data(minify(response.get_data(as_text=True)))
         return response
 
@@ -0,0 +1,3 @@
+"""
+JSON API，供客户端和第三方工具使用
+"""
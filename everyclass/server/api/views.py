@@ -0,0 +1,229 @@
+"""
+课表 JSON API（v1）
+
+返回与查询页面相同的数据，课表使用 `TimetableGrid` 的紧凑表示：`cards` 为课程列表，`slots[day - 1][time - 1]` 为该时间段课程在
+`cards` 中的下标，每门课的上课周次同时以位图 `week_mask` 给出。
+
+响应的 ETag 由 API 版本、数据版本、请求路径和查询参数生成，客户端带 If-None-Match 请求时，未更新的资源直接返回 304，不再调用 api-server。
+学生课表受隐私设置限制，只有公开的学生可以跳过权限检查直接返回 304。
+"""
+import hashlib
+from urllib.parse import urlencode
+
+from ddtrace import tracer
+from flask import Blueprint, jsonify, make_response, request, session
+
+from everyclass.common.time import lesson_string_to_tuple
+from everyclass.rpc.entity import Entity
+from everyclass.server.config import get_config
+from everyclass.server.consts import MSG_INVALID_IDENTIFIER, SESSION_CURRENT_USER, SESSION_LAST_VIEWED_STUDENT
+from everyclass.server.db.dao import PrivacySettings, Redis
+from everyclass.server.models import StudentSession, TimetableGrid, weeks_to_mask
+from everyclass.server.utils import data_version
+from everyclass.server.utils.access_control import check_permission
+from everyclass.server.utils.decorators import disallow_in_maintenance, url_semester_check
+from everyclass.server.utils.resource_identifier_encrypt import decrypt
+from everyclass.server.utils.rpc import handle_exception_with_json
+
+API_VERSION = "v1"
+
+api_v1 = Blueprint('api_v1', __name__)
+
+
+def _error(message: str, status: int):
+    return make_response(jsonify({"success": False, "message": message}), status)
+
+
+def _etag() -> str:
+    """当前请求的 ETag，由 API 版本、数据版本、路径和排序后的查询参数生成，数据版本更新后改变"""
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return hashlib.sha1("{}:{}:{}?{}".format(API_VERSION, data_version(), request.path, query).encode()).hexdigest()
+
+
+def _not_modified(etag: str, public: bool):
+    """客户端缓存仍然有效时返回 304 响应，否则返回 None"""
+    if etag not in request.if_none_match:
+        return None
+    return _with_cache_headers(make_response("", 304), etag, public)
+
+
+def _with_cache_headers(response, etag: str, public: bool):
+    response.set_etag(etag)
+    visibility = "public" if public else "private"
+    response.headers["Cache-Control"] = "{}, max-age={}".format(visibility, get_config().API_CACHE_MAX_AGE)
+    if not public:
+        response.vary.add("Cookie")
+    return response
+
+
+def _json(data: dict, etag: str, public: bool):
+    data["success"] = True
+    data["data_version"] = data_version()
+    return _with_cache_headers(jsonify(data), etag, public)
+
+
+def _teachers(teachers) -> list:
+    return [{"name": teacher.name, "title": teacher.title, "teacher_id": teacher.teacher_id_encoded}
+            for teacher in teachers]
+
+
+def _card(card, week_mask: int = None) -> dict:
+    day, time = lesson_string_to_tuple(card.lesson)
+    return {"card_id"    : card.card_id_encoded,
+            "name"       : card.name,
+            "teachers"   : _teachers(card.teachers),
+            "room"       : card.room,
+            "room_id"    : card.room_id_encoded,
+            "day"        : day,
+            "time"       : time,
+            "week_string": card.week_string,
+            "week_mask"  : weeks_to_mask(card.weeks) if week_mask is None else week_mask}
+
+
+def _timetable(cards) -> dict:
+    grid = TimetableGrid(cards)
+    return {"cards"    : [_card(card, mask) for card, mask in zip(grid.cards, grid.week_masks)],
+            "slots"    : grid.slots,
+            "empty_sat": grid.empty_sat,
+            "empty_sun": grid.empty_sun,
+            "empty_5"  : grid.empty_5,
+            "empty_6"  : grid.empty_6}
+
+
+@api_v1.route('/student/<string:url_sid>/<string:url_semester>')
+@url_semester_check
+@disallow_in_maintenance
+def get_student(url_sid: str, url_semester: str):
+    """学生课表"""
+    try:
+        _, student_id = decrypt(url_sid, resource_type='student')
+    except ValueError:
+        return _error(MSG_INVALID_IDENTIFIER, 400)
+
+    etag = _etag()
+    if PrivacySettings.get_level(student_id) == 0:
+        not_modified = _not_modified(etag, public=False)
+        if not_modified:
+            return not_modified
+
+    with tracer.trace('rpc_get_student_timetable'):
+        try:
+            student = Entity.get_student_timetable(student_id, url_semester)
+        except Exception as e:
+            return handle_exception_with_json(e)
+
+    # 匿名客户端不写入 session，避免每次请求都分配用户 ID 并下发 cookie。已登录用户与查询页面一致，
+    # 权限检查前记录最后浏览的学生，并记录访客
+    current_user = session.get(SESSION_CURRENT_USER, None)
+    if current_user:
+        session[SESSION_LAST_VIEWED_STUDENT] = StudentSession(sid_orig=student.student_id,
+                                                              sid=student.student_id_encoded,
+                                                              name=student.name)
+    has_permission, _ = check_permission(student)
+    if not has_permission:
+        return _error("permission denied", 403)
+
+    if current_user:
+        Redis.add_visitor_count(student.student_id, current_user)
+
+    return _json({"student": {"student_id": student.student_id_encoded,
+                              "name"      : student.name,
+                              "deputy"    : student.deputy,
+                              "klass"     : student.klass,
+                              "semesters" : sorted(student.semesters)},
+                  "semester" : url_semester,
+                  "timetable": _timetable(student.cards)},
+                 etag, public=False)
+
+
+@api_v1.route('/teacher/<string:url_tid>/<string:url_semester>')
+@url_semester_check
+@disallow_in_maintenance
+def get_teacher(url_tid: str, url_semester: str):
+    """教师课表"""
+    try:
+        _, teacher_id = decrypt(url_tid, resource_type='teacher')
+    except ValueError:
+        return _error(MSG_INVALID_IDENTIFIER, 400)
+
+    etag = _etag()
+    not_modified = _not_modified(etag, public=True)
+    if not_modified:
+        return not_modified
+
+    with tracer.trace('rpc_get_teacher_timetable'):
+        try:
+            teacher = Entity.get_teacher_timetable(teacher_id, url_semester)
+        except Exception as e:
+            return handle_exception_with_json(e)
+
+    return _json({"teacher": {"teacher_id": teacher.teacher_id_encoded,
+                              "name"      : teacher.name,
+                              "title"     : teacher.title,
+                              "unit"      : teacher.unit,
+                              "semesters" : sorted(teacher.semesters)},
+                  "semester" : url_semester,
+                  "timetable": _timetable(teacher.cards)},
+                 etag, public=True)
+
+
+@api_v1.route('/classroom/<string:url_rid>/<string:url_semester>')
+@url_semester_check
+@disallow_in_maintenance
+def get_classroom(url_rid: str, url_semester: str):
+    """教室课表"""
+    try:
+        _, room_id = decrypt(url_rid, resource_type='room')
+    except ValueError:
+        return _error(MSG_INVALID_IDENTIFIER, 400)
+
+    etag = _etag()
+    not_modified = _not_modified(etag, public=True)
+    if not_modified:
+        return not_modified
+
+    with tracer.trace('rpc_get_classroom_timetable'):
+        try:
+            room = Entity.get_classroom_timetable(url_semester, room_id)
+        except Exception as e:
+            return handle_exception_with_json(e)
+
+    return _json({"classroom": {"room_id"  : room.room_id_encoded,
+                                "name"     : room.name,
+                                "building" : room.building,
+                                "campus"   : room.campus,
+                                "semesters": sorted(room.semesters)},
+                  "semester" : url_semester,
+                  "timetable": _timetable(room.cards)},
+                 etag, public=True)
+
+
+@api_v1.route('/card/<string:url_cid>/<string:url_semester>')
+@url_semester_check
+@disallow_in_maintenance
+def get_card(url_cid: str, url_semester: str):
+    """
+    课程详情。学生的隐私设置可能在数据版本不变时改变，为了让 ETag 只依赖数据版本，响应中不包含学生名单
+    """
+    try:
+        _, card_id = decrypt(url_cid, resource_type='klass')
+    except ValueError:
+        return _error(MSG_INVALID_IDENTIFIER, 400)
+
+    etag = _etag()
+    not_modified = _not_modified(etag, public=True)
+    if not_modified:
+        return not_modified
+
+    with tracer.trace('rpc_get_card'):
+        try:
+            card = Entity.get_card(url_semester, card_id)
+        except Exception as e:
+            return handle_exception_with_json(e)
+
+    result = _card(card)
+    result.update({"type"         : card.type,
+                   "hour"         : card.hour,
+                   "union_name"   : card.union_name,
+                   "student_count": len(card.students)})
+    return _json({"card": result, "semester": url_semester}, etag, public=True)
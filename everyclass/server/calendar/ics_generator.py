@@ -5,15 +5,16 @@ https://tools.ietf.org/html/rfc2445
 import hashlib
 import os
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from typing import Tuple
 
 import pytz
 from ddtrace import tracer
 from icalendar import Alarm, Calendar, Event, Timezone, TimezoneStandard
 
 from everyclass.common.time import get_time
+from everyclass.rpc.entity import teacher_list_to_name_str
 from everyclass.server.config import get_config
-from everyclass.server.models import Semester
+from everyclass.server.models import Semester, TimetableGrid, mask_to_weeks
 from everyclass.server.utils import calendar_dir
 
 tzc = Timezone()
@@ -26,12 +27,12 @@ tzs.add('TZOFFSETFROM', timedelta(hours=8))
 tzs.add('TZOFFSETTO', timedelta(hours=8))
 
 
-def generate(name: str, cards: Dict[Tuple[int, int], List[Dict]], semester: Semester, filename: str) -> None:
+def generate(name: str, timetable: TimetableGrid, semester: Semester, filename: str) -> None:
     """
     生成 ics 文件并保存到目录
 
     :param name: 姓名
-    :param cards: 参与的课程
+    :param timetable: 课表
     :param semester: 当前导出的学期
     :param filename: 输出的文件名称，带后缀
     :return: None
@@ -57,24 +58,22 @@ def generate(name: str, cards: Dict[Tuple[int, int], List[Dict]], semester: Seme
 
     with tracer.trace("add_events"):
         # 创建 events
-        for time in range(1, 7):
-            for day in range(1, 8):
-                if (day, time) in cards:
-                    for card in cards[(day, time)]:
-                        for week in card['week']:
-                            dtstart = _get_datetime(week, day, get_time(time)[0], semester)
-                            dtend = _get_datetime(week, day, get_time(time)[1], semester)
-
-                            if dtstart.year == 1984:
-                                continue
-
-                            cal.add_component(_build_event(card_name=card['name'],
-                                                           times=(dtstart, dtend),
-                                                           classroom=card['classroom'],
-                                                           teacher=card['teacher'],
-                                                           week_string=card['week_string'],
-                                                           current_week=week,
-                                                           cid=card['cid']))
+        for day, time, card, week_mask in timetable.lessons():
+            teacher = teacher_list_to_name_str(card.teachers)
+            for week in mask_to_weeks(week_mask):
+                dtstart = _get_datetime(week, day, get_time(time)[0], semester)
+                dtend = _get_datetime(week, day, get_time(time)[1], semester)
+
+                if dtstart.year == 1984:
+                    continue
+
+                cal.add_component(_build_event(card_name=card.name,
+                                               times=(dtstart, dtend),
+                                               classroom=card.room,
+                                               teacher=teacher,
+                                               week_string=card.week_string,
+                                               current_week=week,
+                                               cid=card.card_id_encoded))
 
     with tracer.trace("write_file"):
         with open(os.path.join(calendar_dir(), filename), 'wb') as f:
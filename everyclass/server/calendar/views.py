@@ -2,21 +2,18 @@
 日历相关函数
 """
 import os
-from collections import defaultdict
-from typing import Dict, List, Tuple
 
 from ddtrace import tracer
 from flask import Blueprint, abort, current_app as app, jsonify, redirect, render_template, request, \
     send_from_directory, url_for
 
 from everyclass.common.format import is_valid_uuid
-from everyclass.common.time import lesson_string_to_tuple
-from everyclass.rpc.entity import Entity, teacher_list_to_name_str
+from everyclass.rpc.entity import Entity
 from everyclass.server import logger
 from everyclass.server.calendar import ics_generator
 from everyclass.server.consts import MSG_400, MSG_INVALID_IDENTIFIER
 from everyclass.server.db.dao import CalendarToken, PrivacySettings, Redis, User
-from everyclass.server.models import Semester
+from everyclass.server.models import Semester, TimetableGrid
 from everyclass.server.utils import calendar_dir
 from everyclass.server.utils.access_control import check_permission
 from everyclass.server.utils.decorators import disallow_in_maintenance
@@ -115,18 +112,10 @@ def ics_download(calendar_token: str):
             rpc_result = Entity.get_teacher_timetable(result['identifier'], result['semester'])
 
         semester = Semester(result['semester'])
-
-        cards: Dict[Tuple[int, int], List[Dict]] = defaultdict(list)
-        for card in rpc_result.cards:
-            cards[lesson_string_to_tuple(card.lesson)].append(dict(name=card.name,
-                                                                   teacher=teacher_list_to_name_str(card.teachers),
-                                                                   week=card.weeks,
-                                                                   week_string=card.week_string,
-                                                                   classroom=card.room,
-                                                                   cid=card.card_id_encoded))
+        timetable = TimetableGrid(rpc_result.cards)
 
     ics_generator.generate(name=rpc_result.name,
-                           cards=cards,
+                           timetable=timetable,
                            semester=semester,
                            filename=cal_filename)
 
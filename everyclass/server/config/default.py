@@ -84,6 +84,12 @@ class Config(object):
         'port'    : 5432
     }
     POSTGRES_SCHEMA = 'everyclass_server'
+    POSTGRES_PREPARED_STATEMENTS = True  # 热点查询使用预备语句
+    # 只读副本，格式同 POSTGRES_CONNECTION，为 None 时所有查询使用主库
+    POSTGRES_REPLICA_CONNECTION = None
+    POSTGRES_REPLICA_POOL_SIZE = 10
+    POSTGRES_READ_YOUR_WRITES_WINDOW = 10  # 用户写入后多少秒内的只读查询仍使用主库
+    SLOW_QUERY_THRESHOLD = 0.2  # 执行时间超过此秒数的数据库查询会记录日志
 
     # Sentry, APM and logstash
     SENTRY_CONFIG = {
@@ -114,7 +120,18 @@ class Config(object):
     CDN_DOMAIN = 'cdn.domain.com'
     CDN_ENDPOINTS = ['images', 'static']
     CDN_TIMESTAMP = False
-    HTML_MINIFY = True
+    HTML_MINIFY = True  # 在模板编译时删除缩进和空行
+    HTML_MINIFY_RUNTIME = False  # 对每个 HTML 响应运行 htmlmin（CPU 开销较大）
+
+    # 整页缓存：Redis 和进程内缓存的时间（秒）、进程内缓存的页面数，以及 Cache-Control 中的 max-age
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_TTL = 60 * 5
+    PAGE_CACHE_LOCAL_TTL = 30
+    PAGE_CACHE_LOCAL_SIZE = 200
+    PAGE_CACHE_MAX_AGE = 60
+
+    # JSON API 响应 Cache-Control 中的 max-age（秒），过期后客户端使用 ETag 验证
+    API_CACHE_MAX_AGE = 60
     STATIC_VERSIONED = True
     with open(os.path.join(os.path.dirname(__file__), '../../../frontend/rev-manifest.json'), 'r') as static_manifest:
         STATIC_MANIFEST = json.load(static_manifest)
@@ -123,6 +140,7 @@ class Config(object):
     业务设置
     """
     DATA_LAST_UPDATE_TIME = '2018 年 9 月 7 日'  # 数据最后更新日期，在页面下方展示
+    STUDENT_CACHE_TTL = 60 * 60 * 24  # 学生基本信息缓存时间（秒），数据更新后缓存自动失效
     DEFAULT_SEMESTER = (2018, 2019, 1)
     AVAILABLE_SEMESTERS = {
         (2016, 2017, 1): {
@@ -180,9 +198,59 @@ class Config(object):
         'user'         : True
     }
     DEFAULT_PRIVACY_LEVEL = 0
+    COURSE_REVIEWS_PER_PAGE = 20
+    COURSE_REVIEW_LEADERBOARD_MIN_COUNT = 3  # 评价人数达到此数量才进入排行榜
+
+    # 访客记录先写入 Redis 队列，每隔 VISIT_TRACK_FLUSH_INTERVAL 秒批量写入数据库。队列最多保留 MAX_LENGTH 条，
+    # 一批记录写入失败 MAX_ATTEMPTS 次后移入死信列表
+    VISIT_TRACK_FLUSH_INTERVAL = 5
+    VISIT_TRACK_FLUSH_BATCH_SIZE = 500
+    VISIT_TRACK_QUEUE_MAX_LENGTH = 100000
+    VISIT_TRACK_MAX_ATTEMPTS = 5
+
+    # 用户流水 ID 每次从数据库预留的数量。LAZY_USER_ID 为 True 时仅在 session 需要保存时才分配 ID
+    USER_ID_BLOCK_SIZE = 100
+    LAZY_USER_ID = False
+
+    # 过期数据保留天数，None 表示永久保留。日历令牌按最后使用时间计算
+    RETENTION = {
+        'simple_passwords'        : 180,
+        'identity_verify_requests': 30,
+        'calendar_tokens'         : 365
+    }
+    RETENTION_HOUR = 4  # 每天几点执行清理
+    RETENTION_BATCH_SIZE = 1000
+    RETENTION_BATCH_INTERVAL = 0.5  # 每批之间暂停的秒数
+    RETENTION_MAX_DURATION = 60 * 60  # 单次清理最长运行秒数，避免进入高峰期
+
+    # MongoDB 到 PostgreSQL 迁移：每批 COPY 的行数及并行迁移的表数
+    MIGRATION_BATCH_SIZE = 5000
+    MIGRATION_WORKERS = 4
 
     RESOURCE_IDENTIFIER_ENCRYPTION_KEY = 'z094gikTit;5gt5h'
+    RESOURCE_IDENTIFIER_CACHE_SIZE = 50000  # 进程内缓存的资源标识符加密、解密结果数量
+
+    # 密码哈希：算法及迭代次数（需包含迭代次数，修改后旧哈希会在用户下次登录时升级），以及计算哈希使用的线程数
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:150000"
+    PASSWORD_HASH_WORKERS = 2
+
+    # 密码强度检查：每个用户 PERIOD 秒内最多检查 LIMIT 次；弱密码布隆过滤器的容量、误判率和重建间隔（秒）
+    PASSWORD_STRENGTH_CHECK_LIMIT = 30
+    PASSWORD_STRENGTH_CHECK_PERIOD = 60
+    WEAK_PASSWORD_FILTER_CAPACITY = 100000
+    WEAK_PASSWORD_FILTER_ERROR_RATE = 0.001
+    WEAK_PASSWORD_FILTER_REFRESH = 60 * 60 * 24
+
+    # 教务密码验证状态轮询：向 everyclass-auth 查询的最小间隔，以及浏览器轮询的初始和最大间隔（秒）。
+    # 轮询请求不阻塞等待，避免占用 uWSGI 请求线程
+    REGISTER_STATUS_POLL_INTERVAL = 1
+    REGISTER_STATUS_POLL_MAX_INTERVAL = 8
     SESSION_CRYPTO_KEY = b'\xcb\xf2\x19H\xd9l\x05\xc7j\xb2\xd0^}B*\x8d\xb6\x8aPd\x1c%\x83\x1e_\xf0\xb9C\xa9XOC'
+    SESSION_COOKIE_REFRESH_INTERVAL = 60 * 60 * 24  # session 未修改时，每隔多少秒重新下发一次 cookie
+    # session 存储方式："cookie" 为加密后存储在 cookie 中，"redis" 为存储在 Redis 中、cookie 只保存随机的 session ID
+    SESSION_STORE = "cookie"
+    SESSION_REDIS_TTL = 60 * 60 * 24 * 30  # 服务端 session 的过期时间（秒），访问时延长
+    SESSION_REDIS_ANONYMOUS_TTL = 60 * 60  # 只包含自动分配的用户 ID 的服务端 session 的过期时间（秒）
 
     TENCENT_CAPTCHA_AID = ''
     TENCENT_CAPTCHA_SECRET = ''
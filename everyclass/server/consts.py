@@ -12,6 +12,8 @@ SESSION_STUDENT_TO_REGISTER = "student_to_register"
 SESSION_CURRENT_USER = "current_logged_in_user"  # a StudentSession type marking the logged in user
 SESSION_PWD_VER_REQ_ID = "verification_req_id"  # current verification req id, a uuid.UUID type
 SESSION_EMAIL_VER_REQ_ID = "email_verify_req_id"
+SESSION_ISSUED_AT = "issued_at"  # timestamp when the session cookie was last issued
+SESSION_READ_PRIMARY_UNTIL = "read_primary_until"  # timestamp before which read-only queries go to the primary database
 
 """
 错误信息
@@ -1,12 +1,15 @@
 from typing import Dict
 
+from bson import ObjectId
 from flask import Blueprint, escape, flash, redirect, render_template, request, session, url_for
 
 from everyclass.rpc.entity import Entity, teacher_list_to_tid_str
-from everyclass.server.consts import MSG_404, MSG_NOT_IN_COURSE, SESSION_CURRENT_USER
-from everyclass.server.db.dao import COTeachingClass, CourseReview
+from everyclass.server.consts import MSG_400, MSG_404, MSG_INVALID_IDENTIFIER, MSG_NOT_IN_COURSE, \
+    SESSION_CURRENT_USER
+from everyclass.server.db.dao import COTeachingClass, CourseReview, CourseReviewLeaderboard
 from everyclass.server.utils.decorators import login_required
-from everyclass.server.utils.rpc import handle_exception_with_error_page
+from everyclass.server.utils.resource_identifier_encrypt import decrypt
+from everyclass.server.utils.rpc import get_student_profile, handle_exception_with_error_page
 
 cr_blueprint = Blueprint('course_review', __name__)
 
@@ -17,7 +20,7 @@ def is_taking(cotc: Dict) -> bool:
 
     if session.get(SESSION_CURRENT_USER, None):
         # 检查当前用户是否选了这门课
-        student = Entity.get_student(session[SESSION_CURRENT_USER].sid_orig)
+        student = get_student_profile(session[SESSION_CURRENT_USER].sid_orig)
         for semester in sorted(student.semesters, reverse=True):  # 新学期可能性大，学期从新到旧查找
             timetable = Entity.get_student_timetable(session[SESSION_CURRENT_USER].sid_orig, semester)
             for card in timetable.cards:
@@ -30,12 +33,38 @@ def is_taking(cotc: Dict) -> bool:
     return user_is_taking
 
 
+@cr_blueprint.route("/leaderboard")
+def leaderboard():
+    """课程评价排行榜，可按课程或老师筛选"""
+    order_by = request.args.get("order_by", "rate")
+    if order_by not in ("rate", "count"):
+        return render_template('common/error.html', message=MSG_400)
+
+    teacher_id = None
+    if request.args.get("teacher", None):
+        try:
+            _, teacher_id = decrypt(request.args["teacher"], resource_type='teacher')
+        except ValueError:
+            return render_template("common/error.html", message=MSG_INVALID_IDENTIFIER)
+
+    entries = CourseReviewLeaderboard.query(order_by=order_by,
+                                            course_id=request.args.get("course_id", None),
+                                            teacher_id=teacher_id)
+    return render_template('course_review/leaderboard.html',
+                           entries=entries,
+                           order_by=order_by)
+
+
 @cr_blueprint.route("/<cotc_id>")
 def show_review(cotc_id: int):
     """查看某个教学班的评价"""
     cotc_id = int(cotc_id)
+    page = max(request.args.get("page", 1, type=int), 1)
+    before, after = request.args.get("before", None), request.args.get("after", None)
+    if any(cursor and not ObjectId.is_valid(cursor) for cursor in (before, after)):
+        return render_template('common/error.html', message=MSG_400)
 
-    review_info = CourseReview.get_review(cotc_id)
+    review_info = CourseReview.get_review(cotc_id, page=page, before=before, after=after)
     avg_rate = review_info['avg_rate']
     reviews = review_info['reviews']
 
@@ -53,6 +82,11 @@ def show_review(cotc_id: int):
                            count=review_info['count'],
                            avg_rate=avg_rate,
                            reviews=reviews,
+                           histogram=review_info['histogram'],
+                           page=review_info['page'],
+                           pages=review_info['pages'],
+                           newer=review_info['newer'],
+                           older=review_info['older'],
                            user_is_taking=is_taking(cotc),
                            reviewed_by_me=reviewed_by_me)
 
@@ -93,7 +127,7 @@ def edit_review(cotc_id: int):
             return redirect(url_for("course_review.edit_review", cotc_id=cotc_id))
 
         try:
-            student = Entity.get_student(session[SESSION_CURRENT_USER].sid_orig)
+            student = get_student_profile(session[SESSION_CURRENT_USER].sid_orig)
         except Exception as e:
             return handle_exception_with_error_page(e)
 
@@ -22,19 +22,24 @@ $ psql
 # W605 invalid escape sequence '\c'
 import abc
 import datetime
+import json
+import threading
 import time
 import uuid
-from typing import Dict, List, Optional, Union, overload
+from typing import Dict, List, Optional, Set, Tuple, Union, overload
 
+from bson import ObjectId
 from flask import session
-from werkzeug.security import check_password_hash, generate_password_hash
+from pymongo import ReturnDocument
 
 from everyclass.rpc.entity import CardResult, teacher_list_to_tid_str
 from everyclass.server.config import get_config
+from everyclass.server.db.migration import MigrationTask, run_migrations
 from everyclass.server.db.mongodb import get_connection as get_mongodb
-from everyclass.server.db.postgres import pg_conn_context
+from everyclass.server.db.postgres import PreparedStatement, mark_written, pg_conn_context
 from everyclass.server.db.redis import redis
-from everyclass.server.models import StudentSession
+from everyclass.server.models import StudentProfile, StudentSession
+from everyclass.server.utils.password import hash_password, needs_rehash, verify_password
 
 
 def new_user_id_sequence() -> int:
@@ -65,13 +70,39 @@ class PostgresBase(abc.ABC):
 
 class PrivacySettings(PostgresBase):
     """隐私级别"""
+    _select_levels = PreparedStatement("privacy_get_levels",
+                                       "SELECT student_id, level FROM privacy_settings WHERE student_id = ANY(%s)")
+
     @classmethod
     def get_level(cls, student_id: str) -> int:
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            select_query = "SELECT level FROM privacy_settings WHERE student_id=%s"
-            cursor.execute(select_query, (student_id,))
-            result = cursor.fetchone()
-        return result[0] if result is not None else get_config().DEFAULT_PRIVACY_LEVEL
+        return cls.get_levels([student_id])[student_id]
+
+    @classmethod
+    def get_levels(cls, student_ids: List[str]) -> Dict[str, int]:
+        """
+        批量获得隐私级别，用于人名重复页、访客列表、课程学生名单等需要渲染多个学生的页面。
+
+        先查 Redis 缓存，未命中的学号使用一条 `= ANY(%s)` 查询从数据库获得，没有设置过隐私级别的学生使用默认级别。
+
+        :param student_ids: 学号列表
+        :return: 学号到隐私级别的字典
+        """
+        student_ids = list(set(student_ids))
+        if not student_ids:
+            return {}
+
+        levels = {sid: level for sid, level in Redis.get_privacy_levels(student_ids).items() if level is not None}
+        missed = [sid for sid in student_ids if sid not in levels]
+
+        if missed:
+            with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
+                cls._select_levels.execute(cursor, (missed,))
+                result = dict(cursor.fetchall())
+
+            fetched = {sid: result.get(sid, get_config().DEFAULT_PRIVACY_LEVEL) for sid in missed}
+            Redis.set_privacy_levels(fetched)
+            levels.update(fetched)
+        return levels
 
     @classmethod
     def set_level(cls, student_id: str, new_level: int) -> None:
@@ -82,6 +113,8 @@ class PrivacySettings(PostgresBase):
             """
             cursor.execute(insert_query, (student_id, new_level, datetime.datetime.now()))
             conn.commit()
+        mark_written()
+        Redis.set_privacy_levels({student_id: new_level})
 
     @classmethod
     def init(cls) -> None:
@@ -101,22 +134,26 @@ class PrivacySettings(PostgresBase):
 
             conn.commit()
 
+    @classmethod
+    def migration_task(cls) -> MigrationTask:
+        return MigrationTask(collection="privacy_settings",
+                             table="privacy_settings",
+                             columns=("student_id", "level", "create_time"),
+                             transform=lambda each: (each['sid_orig'], each['level'], each['create_time']))
+
     @classmethod
     def migrate(cls) -> None:
         """migrate data from mongodb"""
-        mongo = get_mongodb()
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("privacy_settings").find()
-            for each in results:
-                insert_query = "INSERT INTO privacy_settings (student_id, level, create_time) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['sid_orig'], each['level'], each['create_time']))
-            pg_conn.commit()
-        print("Migration finished.")
+        run_migrations([cls.migration_task()])
 
 
 class CalendarToken(PostgresBase):
     """日历订阅令牌
     """
+    _select_by_token = PreparedStatement("calendar_token_find_by_token", """
+    SELECT type, identifier, semester, token, create_time, last_used_time FROM calendar_tokens
+        WHERE token=%s
+    """)
 
     @classmethod
     def insert_calendar_token(cls, resource_type: str, semester: str, identifier: str) -> str:
@@ -137,6 +174,7 @@ class CalendarToken(PostgresBase):
             """
             cursor.execute(insert_query, (resource_type, identifier, semester, token, datetime.datetime.now()))
             conn.commit()
+        mark_written()
         return str(token)
 
     @classmethod
@@ -164,13 +202,9 @@ class CalendarToken(PostgresBase):
     @classmethod  # noqa: F811
     def find_calendar_token(cls, tid=None, sid=None, semester=None, token=None):
         """通过 token 或者 sid/tid + 学期获得 token 文档"""
-        with pg_conn_context() as conn, conn.cursor() as cursor:
+        with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
             if token:
-                select_query = """
-                SELECT type, identifier, semester, token, create_time, last_used_time FROM calendar_tokens
-                    WHERE token=%s
-                """
-                cursor.execute(select_query, (uuid.UUID(token),))
+                cls._select_by_token.execute(cursor, (uuid.UUID(token),))
                 result = cursor.fetchall()
                 return cls._parse(result[0]) if result else None
             elif (tid or sid) and semester:
@@ -224,6 +258,40 @@ class CalendarToken(PostgresBase):
             """
             cursor.execute(insert_query, (student_id, typ))
             conn.commit()
+        mark_written()
+
+    @classmethod
+    def purge_stale(cls, before: datetime.datetime, limit: int) -> List[Dict]:
+        """
+        删除一批在 before 之前最后使用（从未使用过的按创建时间）的令牌
+
+        :return: 被删除的令牌文档列表
+        """
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            delete_query = """
+            DELETE FROM calendar_tokens WHERE token IN (
+                SELECT token FROM calendar_tokens WHERE COALESCE(last_used_time, create_time) < %s LIMIT %s)
+                RETURNING type, identifier, semester, token;
+            """
+            cursor.execute(delete_query, (before, limit))
+            result = cursor.fetchall()
+            conn.commit()
+        return [cls._parse(each) for each in result]
+
+    @classmethod
+    def referenced_resources(cls, resources: List[Tuple[str, str, str]]) -> Set[Tuple[str, str, str]]:
+        """在 (type, identifier, semester) 列表中找出仍有令牌使用的资源"""
+        if not resources:
+            return set()
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            select_query = """
+            SELECT DISTINCT type, identifier, semester FROM calendar_tokens
+                WHERE (type::text, identifier, semester) IN %s;
+            """
+            cursor.execute(select_query, (tuple(resources),))
+            result = cursor.fetchall()
+            conn.commit()
+        return {tuple(each) for each in result}
 
     @classmethod
     def init(cls) -> None:
@@ -267,51 +335,60 @@ class CalendarToken(PostgresBase):
 
             conn.commit()
 
+    @classmethod
+    def migration_task(cls) -> MigrationTask:
+        return MigrationTask(collection="calendar_token",
+                             table="calendar_tokens",
+                             columns=("type", "identifier", "semester", "token", "create_time", "last_used_time"),
+                             transform=lambda each: (each['type'],
+                                                     each['identifier'],
+                                                     each['semester'],
+                                                     each['token'],
+                                                     each['create_time'],
+                                                     each['last_used'] if 'last_used' in each else None))
+
     @classmethod
     def migrate(cls) -> None:
         """migrate data from mongodb"""
-        mongo = get_mongodb()
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("calendar_token").find()
-            for each in results:
-                insert_query = """
-                INSERT INTO calendar_tokens (type, identifier, semester, token, create_time, last_used_time)
-                    VALUES (%s,%s,%s,%s,%s,%s)
-                """
-
-                cursor.execute(insert_query, (each['type'],
-                                              each['identifier'],
-                                              each['semester'],
-                                              each['token'],
-                                              each['create_time'],
-                                              each['last_used'] if 'last_used' in each else None))
-            pg_conn.commit()
-        print("Migration finished.")
+        run_migrations([cls.migration_task()])
 
 
 class User(PostgresBase):
     """用户表
     """
+    _select_exist = PreparedStatement("user_exist", "SELECT create_time FROM users WHERE student_id=%s")
+    _select_password = PreparedStatement("user_get_password", "SELECT password FROM users WHERE student_id=%s")
 
     @classmethod
     def exist(cls, student_id: str) -> bool:
         """check if a student has registered"""
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            select_query = "SELECT create_time FROM users WHERE student_id=%s"
-            cursor.execute(select_query, (student_id,))
+        with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
+            cls._select_exist.execute(cursor, (student_id,))
             result = cursor.fetchone()
         return result is not None
 
     @classmethod
     def check_password(cls, sid_orig: str, password: str) -> bool:
         """verify a user's password. Return True if password is correct, otherwise return False."""
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            select_query = "SELECT password FROM users WHERE student_id=%s"
-            cursor.execute(select_query, (sid_orig,))
+        with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
+            cls._select_password.execute(cursor, (sid_orig,))
             result = cursor.fetchone()
         if result is None:
             raise ValueError("Student not registered")
-        return check_password_hash(result[0], password)
+        if not verify_password(result[0], password):
+            return False
+
+        # 哈希算法或迭代次数已调整，登录成功时升级旧的密码哈希
+        if needs_rehash(result[0]):
+            cls._update_password(sid_orig, hash_password(password))
+        return True
+
+    @classmethod
+    def _update_password(cls, sid_orig: str, password_hash: str) -> None:
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            cursor.execute("UPDATE users SET password=%s WHERE student_id=%s", (password_hash, sid_orig))
+            conn.commit()
+        mark_written()
 
     @classmethod
     def add_user(cls, sid_orig: str, password: str, password_encrypted: bool = False) -> None:
@@ -324,7 +401,7 @@ class User(PostgresBase):
         import psycopg2.errors
 
         if not password_encrypted:
-            password_hash = generate_password_hash(password)
+            password_hash = hash_password(password)
         else:
             password_hash = password
 
@@ -335,6 +412,7 @@ class User(PostgresBase):
                 conn.commit()
             except psycopg2.errors.UniqueViolation as e:
                 raise ValueError("Student already exists in database") from e
+        mark_written()
 
     @classmethod
     def init(cls) -> None:
@@ -355,18 +433,17 @@ class User(PostgresBase):
 
             conn.commit()
 
+    @classmethod
+    def migration_task(cls) -> MigrationTask:
+        return MigrationTask(collection="user",
+                             table="users",
+                             columns=("student_id", "password", "create_time"),
+                             transform=lambda each: (each['sid_orig'], each["password"], each['create_time']))
+
     @classmethod
     def migrate(cls) -> None:
         """migrate data from mongodb"""
-        mongo = get_mongodb()
-
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("user").find()
-            for each in results:
-                insert_query = "INSERT INTO users (student_id, password, create_time) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['sid_orig'], each["password"], each['create_time']))
-            pg_conn.commit()
-        print("Migration finished.")
+        run_migrations([cls.migration_task()])
 
 
 ID_STATUS_TKN_PASSED = "EMAIL_TOKEN_PASSED"  # email verification passed but password may not set
@@ -390,7 +467,7 @@ class IdentityVerification(PostgresBase):
     def get_request_by_id(cls, req_id: str) -> Optional[Dict]:
         """由 request_id 获得请求，如果找不到则返回 None"""
 
-        with pg_conn_context() as conn, conn.cursor() as cursor:
+        with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
             insert_query = """
             SELECT request_id, identifier, method, status, extra
                 FROM identity_verify_requests WHERE request_id = %s;
@@ -427,10 +504,11 @@ class IdentityVerification(PostgresBase):
 
         request_id = uuid.uuid4()
 
+        extra_doc = {}
+        if password:  # 在取得数据库连接前计算哈希，避免计算期间占用连接
+            extra_doc.update({"password": hash_password(password)})
+
         with pg_conn_context() as conn, conn.cursor() as cursor:
-            extra_doc = {}
-            if password:
-                extra_doc.update({"password": generate_password_hash(password)})
 
             insert_query = """
             INSERT INTO identity_verify_requests (request_id, identifier, method, status, create_time, extra)
@@ -443,6 +521,7 @@ class IdentityVerification(PostgresBase):
                                           datetime.datetime.now(),
                                           extra_doc))
             conn.commit()
+        mark_written()
 
         return str(request_id)
 
@@ -456,6 +535,20 @@ class IdentityVerification(PostgresBase):
             """
             cursor.execute(insert_query, (status, uuid.UUID(request_id)))
             conn.commit()
+        mark_written()
+
+    @classmethod
+    def purge(cls, before: datetime.datetime, limit: int) -> int:
+        """删除一批在 before 之前创建的验证请求，返回删除的条数"""
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            delete_query = """
+            DELETE FROM identity_verify_requests WHERE request_id IN (
+                SELECT request_id FROM identity_verify_requests WHERE create_time < %s LIMIT %s);
+            """
+            cursor.execute(delete_query, (before, limit))
+            count = cursor.rowcount
+            conn.commit()
+        return count
 
     @classmethod
     def init(cls) -> None:
@@ -497,27 +590,22 @@ class IdentityVerification(PostgresBase):
 
             conn.commit()
 
+    @classmethod
+    def migration_task(cls) -> MigrationTask:
+        return MigrationTask(collection="verification_requests",
+                             table="identity_verify_requests",
+                             columns=("request_id", "identifier", "method", "status", "create_time", "extra"),
+                             transform=lambda each: (each['request_id'],
+                                                     each['sid_orig'],
+                                                     each['verification_method'],
+                                                     each['status'],
+                                                     each['create_time'],
+                                                     {'password': each['password']} if 'password' in each else None))
+
     @classmethod
     def migrate(cls):
         """migrate data from mongodb"""
-        mongo = get_mongodb()
-
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("verification_requests").find()
-            for each in results:
-                insert_query = """
-                INSERT INTO identity_verify_requests (request_id, identifier, method, status, create_time, extra)
-                    VALUES (%s,%s,%s,%s,%s,%s)
-                """
-
-                cursor.execute(insert_query, (each['request_id'],
-                                              each['sid_orig'],
-                                              each['verification_method'],
-                                              each['status'],
-                                              each['create_time'],
-                                              {'password': each['password']} if 'password' in each else None))
-            pg_conn.commit()
-        print("Migration finished.")
+        run_migrations([cls.migration_task()])
 
 
 class SimplePassword(PostgresBase):
@@ -535,6 +623,27 @@ class SimplePassword(PostgresBase):
             cursor.execute(insert_query, (sid_orig, datetime.datetime.now(), password))
             conn.commit()
 
+    @classmethod
+    def distinct_passwords(cls, limit: int) -> List[str]:
+        """获得至多 limit 个不同的简单密码，出现次数多的优先"""
+        with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
+            select_query = "SELECT password FROM simple_passwords GROUP BY password ORDER BY count(*) DESC LIMIT %s"
+            cursor.execute(select_query, (limit,))
+            return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def purge(cls, before: datetime.datetime, limit: int) -> int:
+        """删除一批在 before 之前的记录，返回删除的条数"""
+        with pg_conn_context() as conn, conn.cursor() as cursor:
+            delete_query = """
+            DELETE FROM simple_passwords WHERE ctid = ANY(ARRAY(
+                SELECT ctid FROM simple_passwords WHERE "time" < %s LIMIT %s));
+            """
+            cursor.execute(delete_query, (before, limit))
+            count = cursor.rowcount
+            conn.commit()
+        return count
+
     @classmethod
     def init(cls) -> None:
         with pg_conn_context() as conn, conn.cursor() as cursor:
@@ -558,30 +667,53 @@ class SimplePassword(PostgresBase):
             cursor.execute(create_index_query)
             conn.commit()
 
+    @classmethod
+    def migration_task(cls) -> MigrationTask:
+        return MigrationTask(collection="simple_passwords",
+                             table="simple_passwords",
+                             columns=("student_id", "time", "password"),
+                             transform=lambda each: (each['sid_orig'], each['time'], each['password']))
+
     @classmethod
     def migrate(cls):
         """migrate data from mongodb"""
-        mongo = get_mongodb()
-
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("simple_passwords").find()
-            for each in results:
-                insert_query = "INSERT INTO simple_passwords (student_id, time, password) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['sid_orig'], each['time'], each['password']))
-            pg_conn.commit()
-        print("Migration finished.")
+        run_migrations([cls.migration_task()])
 
 
 class UserIdSequence(PostgresBase):
+    """
+    用户流水 ID（hi/lo 分配）
+
+    序列的步长为 USER_ID_BLOCK_SIZE，每次 nextval 相当于为当前进程预留一段 ID，之后在进程内依次分配，用完再取下一段。
+    """
+    _lock = threading.Lock()
+    _next = 0
+    _end = 0
+
     @classmethod
     def new(cls):
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            get_sequence_query = """SELECT nextval('user_id_seq')"""
-            cursor.execute(get_sequence_query)
-            num = cursor.fetchone()[0]
-
+        with cls._lock:
+            if cls._next >= cls._end:
+                with pg_conn_context() as conn, conn.cursor() as cursor:
+                    # 以序列实际的步长为准，避免配置与数据库不一致时分配出重复的 ID
+                    get_sequence_query = """
+                    SELECT nextval('user_id_seq'), increment_by FROM pg_sequences
+                        WHERE schemaname = current_schema() AND sequencename = 'user_id_seq'
+                    """
+                    cursor.execute(get_sequence_query)
+                    start, block_size = cursor.fetchone()
+                cls._next, cls._end = start, start + block_size
+
+            num = cls._next
+            cls._next += 1
         return num
 
+    @classmethod
+    def reset(cls) -> None:
+        """丢弃当前进程预留的 ID 段（fork 后调用，避免子进程之间重复分配）"""
+        with cls._lock:
+            cls._next = cls._end = 0
+
     @classmethod
     def init(cls) -> None:
         with pg_conn_context() as conn, conn.cursor() as cursor:
@@ -589,6 +721,9 @@ class UserIdSequence(PostgresBase):
             CREATE SEQUENCE IF NOT EXISTS user_id_seq START WITH 10000000;
             """
             cursor.execute(create_table_query)
+
+            alter_increment_query = "ALTER SEQUENCE user_id_seq INCREMENT BY %s;"
+            cursor.execute(alter_increment_query, (get_config().USER_ID_BLOCK_SIZE,))
             conn.commit()
 
 
@@ -598,24 +733,64 @@ class VisitTrack(PostgresBase):
 
     目前只考虑了学生互访的情况，如果将来老师支持注册，这里需要改动
     """
+    # 以数组传入一批记录，使批量写入也可以使用同一条预备语句
+    _upsert_tracks = PreparedStatement("visit_track_upsert", """
+    INSERT INTO visit_tracks (host_id, visitor_id, last_visit_time)
+        SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::timestamptz[])
+        ON CONFLICT ON CONSTRAINT unq_host_visitor
+        DO UPDATE SET last_visit_time=GREATEST(visit_tracks.last_visit_time, EXCLUDED.last_visit_time);
+    """)
 
     @classmethod
     def update_track(cls, host: str, visitor: StudentSession) -> None:
+        """
+        记录一次访问。访问记录先放入 Redis 队列，由后台定时任务 `flush_queue` 批量写入数据库，页面响应不再等待数据库写入。
+        不在 uWSGI 中运行（开发服务器、测试等）时没有定时任务，直接写入数据库
+        """
+        from everyclass.server import uwsgi_available
 
-        with pg_conn_context() as conn, conn.cursor() as cursor:
-            insert_or_update_query = """
-            INSERT INTO visit_tracks (host_id, visitor_id, last_visit_time) VALUES (%s,%s,%s)
-                ON CONFLICT ON CONSTRAINT unq_host_visitor DO UPDATE SET last_visit_time=EXCLUDED.last_visit_time;
-            """
-            cursor.execute(insert_or_update_query, (host, visitor.sid_orig, datetime.datetime.now()))
-            conn.commit()
+        Redis.push_visit_track(host, visitor.sid_orig, datetime.datetime.now(), get_config().VISIT_TRACK_QUEUE_MAX_LENGTH)
+        if not uwsgi_available:
+            cls.flush_queue()
+
+    @classmethod
+    def flush_queue(cls) -> int:
+        """
+        从 Redis 队列中取出访问记录并批量写入数据库。同一 (host, visitor) 只保留最近一次访问时间。
+        记录在提交事务后才从 Redis 中删除，写入失败时留在处理中列表，下次调用时重试。重试 VISIT_TRACK_MAX_ATTEMPTS 次仍失败的
+        一批记录移入死信列表，不再阻塞后面的记录。
+
+        :return: 写入数据库的记录条数
+        """
+        config = get_config()
+        total = 0
+        while True:
+            tracks, dead = Redis.claim_visit_tracks(config.VISIT_TRACK_FLUSH_BATCH_SIZE, config.VISIT_TRACK_MAX_ATTEMPTS)
+            if dead:
+                from everyclass.server import logger
+                logger.warning(f"Moved {dead} visit tracks to dead letter list after repeated failures.")
+            if not tracks:
+                break
+
+            latest: Dict[tuple, datetime.datetime] = {}
+            for host, visitor, visit_time in tracks:
+                if (host, visitor) not in latest or latest[(host, visitor)] < visit_time:
+                    latest[(host, visitor)] = visit_time
+
+            with pg_conn_context() as conn, conn.cursor() as cursor:
+                hosts, visitors = zip(*latest.keys())
+                cls._upsert_tracks.execute(cursor, (list(hosts), list(visitors), list(latest.values())))
+                conn.commit()
+            Redis.ack_visit_tracks()
+            total += len(latest)
+        return total
 
     @classmethod
     def get_visitors(cls, sid_orig: str) -> List[Dict]:
         """获得访客列表"""
         from everyclass.rpc.entity import Entity
 
-        with pg_conn_context() as conn, conn.cursor() as cursor:
+        with pg_conn_context(read_only=True) as conn, conn.cursor() as cursor:
             select_query = """
             SELECT visitor_id, last_visit_time FROM visit_tracks where host_id=%s ORDER BY last_visit_time DESC;
             """
@@ -632,6 +807,10 @@ class VisitTrack(PostgresBase):
                                  "student_id"   : search_result.students[0].student_id_encoded,
                                  "last_semester": search_result.students[0].semesters[-1],
                                  "visit_time"   : record[1]})
+
+        privacy_levels = PrivacySettings.get_levels([record[0] for record in result])
+        for record, visitor in zip(result, visitor_list):
+            visitor["privacy_level"] = privacy_levels[record[0]]
         return visitor_list
 
     @classmethod
@@ -663,17 +842,17 @@ class VisitTrack(PostgresBase):
             cursor.execute(create_constraint_query)
             conn.commit()
 
+    @classmethod
+    def migration_task(cls) -> MigrationTask:
+        return MigrationTask(collection="visitor_track",
+                             table="visit_tracks",
+                             columns=("host_id", "visitor_id", "last_visit_time"),
+                             transform=lambda each: (each['host'], each['visitor'], each['last_time']))
+
     @classmethod
     def migrate(cls) -> None:
         """migrate data from mongodb"""
-        mongo = get_mongodb()
-        with pg_conn_context() as pg_conn, pg_conn.cursor() as cursor:
-            results = mongo.get_collection("visitor_track").find()
-            for each in results:
-                insert_query = "INSERT INTO visit_tracks (host_id, visitor_id, last_visit_time) VALUES (%s,%s,%s)"
-                cursor.execute(insert_query, (each['host'], each['visitor'], each['last_time']))
-            pg_conn.commit()
-        print("Migration finished.")
+        run_migrations([cls.migration_task()])
 
 
 class COTeachingClass(MongoDAOBase):
@@ -696,10 +875,8 @@ class COTeachingClass(MongoDAOBase):
     collection_name = "co_tea_classes"
 
     @classmethod
-    def get_id_by_card(cls, card: CardResult) -> int:
-        """
-        从 api-server 返回的 CardResult 获得对应的“教学班集合” ID，如果不存在则新建
-        """
+    def _card_to_doc(cls, card: CardResult) -> Dict:
+        """由 CardResult 生成教学班集合文档（不含 cotc_id）"""
         teachers = [{"name": x.name, "teacher_id": x.teacher_id} for x in card.teachers]
         teacher_name_str = '、'.join([x.name for x in card.teachers])
 
@@ -721,16 +898,33 @@ class COTeachingClass(MongoDAOBase):
                     card_name = card_name + "-重修"
                     break
 
+        return {'course_id'       : card.course_id,
+                'teach_type'      : teach_type,
+                'teacher_id_str'  : teacher_list_to_tid_str(card.teachers),
+                'name'            : card_name,
+                'teachers'        : teachers,
+                'teacher_name_str': teacher_name_str}
+
+    @classmethod
+    def _key(cls, doc: Dict) -> Tuple[str, int, str]:
+        return doc['course_id'], doc['teach_type'], doc['teacher_id_str']
+
+    @classmethod
+    def get_id_by_card(cls, card: CardResult) -> int:
+        """
+        从 api-server 返回的 CardResult 获得对应的“教学班集合” ID，如果不存在则新建
+        """
+        doc = cls._card_to_doc(card)
+
         db = get_mongodb()
-        doc = db.get_collection(cls.collection_name).find_one_and_update({'course_id'     : card.course_id,
-                                                                          'teach_type'    : teach_type,
-                                                                          'teacher_id_str': teacher_list_to_tid_str(
-                                                                                  card.teachers)},
+        doc = db.get_collection(cls.collection_name).find_one_and_update({'course_id'     : doc['course_id'],
+                                                                          'teach_type'    : doc['teach_type'],
+                                                                          'teacher_id_str': doc['teacher_id_str']},
                                                                          {"$setOnInsert": {
                                                                              "cotc_id"         : Redis.new_cotc_id(),
-                                                                             'name'            : card_name,
-                                                                             'teachers'        : teachers,
-                                                                             'teacher_name_str': teacher_name_str
+                                                                             'name'            : doc['name'],
+                                                                             'teachers'        : doc['teachers'],
+                                                                             'teacher_name_str': doc['teacher_name_str']
                                                                          }},
                                                                          upsert=True,
                                                                          new=True)
@@ -739,6 +933,51 @@ class COTeachingClass(MongoDAOBase):
 
         return doc['cotc_id']
 
+    @classmethod
+    def get_ids_by_cards(cls, cards: List[CardResult]) -> List[int]:
+        """
+        批量获得一组课程对应的“教学班集合” ID，顺序与 cards 一致，不存在的教学班集合会被新建。
+
+        先查 Redis 缓存，未命中的使用一次 `$in` 查询，仍不存在的使用 `insert_many` 一次性新建。
+        """
+        from pymongo.errors import BulkWriteError
+
+        docs = [cls._card_to_doc(card) for card in cards]
+        keys = list({cls._key(doc): None for doc in docs})  # 去重并保持顺序
+        if not keys:
+            return []
+
+        cotc_ids = {key: cotc_id for key, cotc_id in Redis.get_cotc_ids(keys).items() if cotc_id is not None}
+        missed = [key for key in keys if key not in cotc_ids]
+
+        if missed:
+            collection = get_mongodb().get_collection(cls.collection_name)
+
+            def find_missed():
+                found = {}
+                for doc in collection.find({"course_id": {"$in": list({key[0] for key in missed})}},
+                                           {"course_id": 1, "teach_type": 1, "teacher_id_str": 1, "cotc_id": 1}):
+                    if cls._key(doc) in missed:
+                        found[cls._key(doc)] = doc["cotc_id"]
+                return found
+
+            found = find_missed()
+            to_insert = {cls._key(doc): doc for doc in docs if cls._key(doc) in missed and cls._key(doc) not in found}
+            if to_insert:
+                new_ids = Redis.new_cotc_ids(len(to_insert))
+                new_docs = [dict(doc, cotc_id=cotc_id) for doc, cotc_id in zip(to_insert.values(), new_ids)]
+                try:
+                    collection.insert_many(new_docs, ordered=False)
+                    found.update({cls._key(doc): doc["cotc_id"] for doc in new_docs})
+                except BulkWriteError:
+                    # 部分文档已被其他请求并发插入，重新查询获得最终的 ID
+                    found = find_missed()
+
+            Redis.set_cotc_ids(found)
+            cotc_ids.update(found)
+
+        return [cotc_ids[cls._key(doc)] for doc in docs]
+
     @classmethod
     def get_doc(cls, cotc_id: int) -> Optional[Dict]:
         """获得 cotc_id 对应的文档，可能为 None """
@@ -770,45 +1009,59 @@ class CourseReview(MongoDAOBase):
     collection_name = "course_reviews"
 
     @classmethod
-    def get_review(cls, cotc_id: int) -> Dict:
+    def get_review(cls, cotc_id: int, page: int = 1, before: str = None, after: str = None) -> Dict:
         """
-        获得一个教学班集合的评价
+        获得一个教学班集合的评价。评分统计来自 `CourseReviewSummary`，评价内容按时间倒序分页返回。
+        分页使用 `_id` 范围而不是 skip，翻到很后面的页也只需要读取一页的文档
         {
             "avg_rate": 4.3,
             "count"   : 1,
+            "histogram": {"1": 0, "2": 0, "3": 0, "4": 0, "5": 1},
+            "page"    : 1,
+            "pages"   : 1,
+            "newer"   : None,  # 上一页的游标，没有上一页时为 None
+            "older"   : None,  # 下一页的游标，没有下一页时为 None
             "reviews": [
                 {
-                    "review"  : "老师讲得好",
-                    "rate"    : 5,
-                    "stu_name": "16级软件工程专业学生"
+                    "review"      : "老师讲得好",
+                    "rate"        : 5,
+                    "student_name": "16级软件工程专业学生"
                 },
             ]
         }
 
         :param cotc_id: 教学班集合 ID
+        :param page: 页码，从 1 开始，仅用于展示
+        :param before: 返回此游标之前（更早）的评价，即下一页
+        :param after: 返回此游标之后（更新）的评价，即上一页
         :return:
         """
-        db = get_mongodb()
-        result = db.get_collection(cls.collection_name).aggregate([
-            {"$match": {"cotc_id": int(cotc_id)}},
-            {"$project": {
-                "_id"       : 0,
-                "student_id": 0,
-                "cotc_id"   : 0}},
-            {"$group": {"_id"     : None,
-                        "avg_rate": {"$avg": "$rate"},
-                        "reviews" : {"$push": "$$ROOT"},
-                        "count"   : {"$sum": 1}}}
-        ])
-        result = list(result)
+        per_page = get_config().COURSE_REVIEWS_PER_PAGE
+        summary = CourseReviewSummary.get(cotc_id)
 
-        if result:
-            result = result[0]
-        else:
-            result = {"avg_rate": 0,
-                      "reviews" : [],
-                      "count"   : 0}
-        return result
+        query: Dict = {"cotc_id": int(cotc_id)}
+        if after:
+            query["_id"] = {"$gt": ObjectId(after)}
+        elif before:
+            query["_id"] = {"$lt": ObjectId(before)}
+
+        db = get_mongodb()
+        reviews = list(db.get_collection(cls.collection_name).find(query, {"student_id": 0, "cotc_id": 0})
+                       .sort("_id", 1 if after else -1)
+                       .limit(per_page + 1))
+        has_more = len(reviews) > per_page
+        reviews = reviews[:per_page]
+        if after:
+            reviews.reverse()
+        has_newer, has_older = (has_more, True) if after else (before is not None, has_more)
+
+        ids = [str(review.pop("_id")) for review in reviews]
+        summary.update({"reviews": reviews,
+                        "page"   : page,
+                        "pages"  : max((summary["count"] + per_page - 1) // per_page, 1),
+                        "newer"  : ids[0] if ids and has_newer else None,
+                        "older"  : ids[-1] if ids and has_older else None})
+        return summary
 
     @classmethod
     def get_my_review(cls, cotc_id: int, student_id: str) -> Dict:
@@ -820,12 +1073,99 @@ class CourseReview(MongoDAOBase):
     @classmethod
     def edit_my_review(cls, cotc_id: int, student_id: str, rate: int, review: str, name: str) -> None:
         db = get_mongodb()
-        db.get_collection(cls.collection_name).update_one(filter={"cotc_id"   : cotc_id,
-                                                                  "student_id": student_id},
-                                                          update={"$set": {"rate"        : rate,
-                                                                           "review"      : review,
-                                                                           "student_name": name}},
-                                                          upsert=True)
+        old_doc = db.get_collection(cls.collection_name).find_one_and_update(
+                filter={"cotc_id"   : cotc_id,
+                        "student_id": student_id},
+                update={"$set": {"rate"        : rate,
+                                 "review"      : review,
+                                 "student_name": name}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE)
+        CourseReviewSummary.update(cotc_id, new_rate=rate, old_rate=old_doc["rate"] if old_doc else None)
+
+    @classmethod
+    def create_index(cls) -> None:
+        db = get_mongodb()
+        collection = db.get_collection(cls.collection_name)
+        # 旧版本在 cotc_id 上建立了唯一索引，每门课只能有一条评价
+        if "cotc_id_1" in collection.index_information():
+            collection.drop_index("cotc_id_1")
+        collection.create_index([("cotc_id", 1), ("student_id", 1)], unique=True)
+        collection.create_index([("cotc_id", 1), ("_id", -1)])
+
+
+class CourseReviewSummary(MongoDAOBase):
+    """
+    课程评价统计，随评价的增加和修改增量更新，查看评价时不再需要对所有评价做聚合
+
+    {
+        "cotc_id"  : 1,
+        "count"    : 2,
+        "sum"      : 9,
+        "histogram": {"1": 0, "2": 0, "3": 0, "4": 1, "5": 1}
+    }
+    """
+    collection_name = "course_review_summaries"
+
+    @classmethod
+    def _format(cls, doc: Optional[Dict]) -> Dict:
+        histogram = {str(rate): 0 for rate in range(1, 6)}
+        if not doc:
+            return {"avg_rate": 0, "count": 0, "histogram": histogram}
+        histogram.update(doc.get("histogram", {}))
+        return {"avg_rate" : round(doc["sum"] / doc["count"], 1) if doc["count"] else 0,
+                "count"    : doc["count"],
+                "histogram": histogram}
+
+    @classmethod
+    def get_many(cls, cotc_ids: List[int]) -> Dict[int, Dict]:
+        """批量获得评分统计，使用一次 `$in` 查询"""
+        db = get_mongodb()
+        docs = {doc["cotc_id"]: doc for doc in
+                db.get_collection(cls.collection_name).find({"cotc_id": {"$in": list(set(cotc_ids))}})}
+        return {cotc_id: cls._format(docs.get(cotc_id)) for cotc_id in cotc_ids}
+
+    @classmethod
+    def get(cls, cotc_id: int) -> Dict:
+        """获得一个教学班集合的评分统计，包括平均分、评分人数和各分数的人数"""
+        db = get_mongodb()
+        return cls._format(db.get_collection(cls.collection_name).find_one({"cotc_id": int(cotc_id)}))
+
+    @classmethod
+    def update(cls, cotc_id: int, new_rate: int, old_rate: Optional[int] = None) -> None:
+        """
+        评价新增或修改后原子地更新统计
+
+        :param new_rate: 新的评分
+        :param old_rate: 修改前的评分，新增评价时为 None
+        """
+        if old_rate is None:
+            inc = {"count": 1, "sum": new_rate, f"histogram.{new_rate}": 1}
+        elif old_rate == new_rate:
+            return
+        else:
+            inc = {"sum": new_rate - old_rate, f"histogram.{new_rate}": 1, f"histogram.{old_rate}": -1}
+
+        db = get_mongodb()
+        db.get_collection(cls.collection_name).update_one({"cotc_id": int(cotc_id)}, {"$inc": inc}, upsert=True)
+
+    @classmethod
+    def rebuild(cls) -> None:
+        """由现有评价重新生成所有统计"""
+        db = get_mongodb()
+        summaries: Dict[int, Dict] = {}
+        for group in db.get_collection(CourseReview.collection_name).aggregate([
+            {"$group": {"_id"  : {"cotc_id": "$cotc_id", "rate": "$rate"},
+                        "count": {"$sum": 1}}}
+        ]):
+            cotc_id, rate = group["_id"]["cotc_id"], group["_id"]["rate"]
+            summary = summaries.setdefault(cotc_id, {"cotc_id": cotc_id, "count": 0, "sum": 0, "histogram": {}})
+            summary["count"] += group["count"]
+            summary["sum"] += rate * group["count"]
+            summary["histogram"][str(rate)] = group["count"]
+
+        for cotc_id, summary in summaries.items():
+            db.get_collection(cls.collection_name).replace_one({"cotc_id": cotc_id}, summary, upsert=True)
 
     @classmethod
     def create_index(cls) -> None:
@@ -833,6 +1173,79 @@ class CourseReview(MongoDAOBase):
         db.get_collection(cls.collection_name).create_index([("cotc_id", 1)], unique=True)
 
 
+class CourseReviewLeaderboard(MongoDAOBase):
+    """
+    课程评价排行榜，由 `build` 定时从评分统计生成，查询时只读取预先计算好的文档
+
+    {
+        "cotc_id"         : 1,
+        "course_id"       : "39056X1",
+        "name"            : "软件工程基础",
+        "teacher_id_str"  : "15643;16490",
+        "teacher_name_str": "杨柳",
+        "teacher_ids"     : ["15643", "16490"],
+        "avg_rate"        : 4.5,
+        "count"           : 2
+    }
+    """
+    collection_name = "course_review_leaderboard"
+
+    @classmethod
+    def build(cls) -> None:
+        """重新生成排行榜。`$out` 会原子地替换整个集合并保留索引"""
+        db = get_mongodb()
+        db.get_collection(CourseReviewSummary.collection_name).aggregate([
+            {"$match": {"count": {"$gte": get_config().COURSE_REVIEW_LEADERBOARD_MIN_COUNT}}},
+            {"$lookup": {"from"        : COTeachingClass.collection_name,
+                         "localField"  : "cotc_id",
+                         "foreignField": "cotc_id",
+                         "as"          : "cotc"}},
+            {"$unwind": "$cotc"},
+            {"$project": {"_id"             : 0,
+                          "cotc_id"         : 1,
+                          "count"           : 1,
+                          "avg_rate"        : {"$divide": ["$sum", "$count"]},
+                          "course_id"       : "$cotc.course_id",
+                          "name"            : "$cotc.name",
+                          "teacher_id_str"  : "$cotc.teacher_id_str",
+                          "teacher_name_str": "$cotc.teacher_name_str",
+                          "teacher_ids"     : "$cotc.teachers.teacher_id"}},
+            {"$out": cls.collection_name}
+        ])
+
+    @classmethod
+    def query(cls, order_by: str = "rate", course_id: str = None, teacher_id: str = None,
+              limit: int = 50) -> List[Dict]:
+        """
+        查询排行榜
+
+        :param order_by: rate 按平均分排序，count 按评价人数排序
+        :param course_id: 只看某门课程
+        :param teacher_id: 只看某位老师
+        :param limit: 返回条数
+        """
+        if order_by not in ("rate", "count"):
+            raise ValueError("order_by must be one of rate, count")
+
+        condition = {}
+        if course_id:
+            condition["course_id"] = course_id
+        if teacher_id:
+            condition["teacher_ids"] = teacher_id
+        sort = [("avg_rate", -1), ("count", -1)] if order_by == "rate" else [("count", -1), ("avg_rate", -1)]
+
+        db = get_mongodb()
+        return list(db.get_collection(cls.collection_name).find(condition, {"_id": 0}).sort(sort).limit(limit))
+
+    @classmethod
+    def create_index(cls) -> None:
+        db = get_mongodb()
+        collection = db.get_collection(cls.collection_name)
+        for prefix in ([], [("course_id", 1)], [("teacher_ids", 1)]):
+            collection.create_index(prefix + [("avg_rate", -1), ("count", -1)])
+            collection.create_index(prefix + [("count", -1), ("avg_rate", -1)])
+
+
 SECONDS_IN_HOUR = 60 * 60
 
 
@@ -840,25 +1253,91 @@ class Redis:
     prefix = "ec_sv"
 
     @classmethod
-    def set_student(cls, student: StudentSession):
-        """学生信息写入 Redis"""
-        redis.set("{}:stu:{}".format(cls.prefix, student.sid_orig), student.name + "," + student.sid,
-                  ex=86400)
+    def set_student(cls, student: StudentProfile, data_version: str) -> None:
+        """学生基本信息写入 Redis，键中包含数据版本"""
+        redis.set("{}:stu:{}:{}".format(cls.prefix, data_version, student.student_id),
+                  json.dumps(student._asdict(), ensure_ascii=False),
+                  ex=get_config().STUDENT_CACHE_TTL)
 
     @classmethod
-    def get_student(cls, sid_orig: str) -> Optional[StudentSession]:
-        """从 Redis 中获取学生信息，有则返回 StudentSession 对象，无则返回 None"""
-        res = redis.get("{}:stu:{}".format(cls.prefix, sid_orig))
+    def get_student(cls, sid_orig: str, data_version: str) -> Optional[StudentProfile]:
+        """从 Redis 中获取当前数据版本的学生基本信息，有则返回 StudentProfile 对象，无则返回 None"""
+        res = redis.get("{}:stu:{}:{}".format(cls.prefix, data_version, sid_orig))
         if res:
-            name, sid = res.decode().split(",")
-            return StudentSession(sid_orig=sid_orig, sid=sid, name=name)
+            return StudentProfile(**json.loads(res.decode()))
         else:
             return None
 
+    @classmethod
+    def get_privacy_levels(cls, student_ids: List[str]) -> Dict[str, Optional[int]]:
+        """批量获取缓存的隐私级别，未缓存的学号值为 None"""
+        res = redis.mget(["{}:privacy:{}".format(cls.prefix, sid) for sid in student_ids])
+        return {sid: int(level) if level is not None else None for sid, level in zip(student_ids, res)}
+
+    @classmethod
+    def set_privacy_levels(cls, levels: Dict[str, int]) -> None:
+        """批量缓存隐私级别"""
+        pipe = redis.pipeline(transaction=False)
+        for sid, level in levels.items():
+            pipe.set("{}:privacy:{}".format(cls.prefix, sid), level, ex=SECONDS_IN_HOUR)
+        pipe.execute()
+
+    @classmethod
+    def push_visit_track(cls, host: str, visitor: str, visit_time: datetime.datetime, max_length: int) -> None:
+        """访问记录放入队列头部，等待批量写入数据库。队列超过 max_length 条时丢弃最早的记录"""
+        key = "{}:visit_track_queue".format(cls.prefix)
+        pipe = redis.pipeline(transaction=False)
+        pipe.lpush(key, f"{host},{visitor},{visit_time.timestamp()}")
+        pipe.ltrim(key, 0, max_length - 1)
+        pipe.execute()
+
+    @classmethod
+    def claim_visit_tracks(cls, count: int, max_attempts: int) -> Tuple[List[tuple], int]:
+        """
+        从队列尾部（最早的记录）将至多 count 条访问记录移入处理中列表，写入数据库后调用 `ack_visit_tracks` 删除。
+
+        处理中列表不为空说明上次写入失败或进程退出，此时直接返回其中的记录重新写入，不会丢失访问记录。同一批记录已尝试
+        max_attempts 次时移入死信列表，改为取新的一批。
+
+        :return: (host, visitor, visit_time) 列表，以及本次移入死信列表的记录条数
+        """
+        queue_key = "{}:visit_track_queue".format(cls.prefix)
+        processing_key = "{}:visit_track_processing".format(cls.prefix)
+        attempts_key = "{}:visit_track_attempts".format(cls.prefix)
+
+        dead = 0
+        items = redis.lrange(processing_key, 0, -1)
+        if items and redis.incr(attempts_key) > max_attempts:
+            dead_key = "{}:visit_track_dead".format(cls.prefix)
+            pipe = redis.pipeline(transaction=True)
+            pipe.rpush(dead_key, *items)
+            pipe.ltrim(dead_key, -100000, -1)
+            pipe.delete(processing_key, attempts_key)
+            pipe.execute()
+            dead, items = len(items), []
+        if not items:
+            pipe = redis.pipeline(transaction=False)
+            for _ in range(count):
+                pipe.rpoplpush(queue_key, processing_key)
+            items = [item for item in pipe.execute() if item is not None]
+
+        tracks = []
+        for item in items:
+            host, visitor, timestamp = item.decode().split(",")
+            tracks.append((host, visitor, datetime.datetime.fromtimestamp(float(timestamp))))
+        return tracks, dead
+
+    @classmethod
+    def ack_visit_tracks(cls) -> None:
+        """处理中列表的访问记录已写入数据库，删除处理中列表和重试次数"""
+        redis.delete("{}:visit_track_processing".format(cls.prefix), "{}:visit_track_attempts".format(cls.prefix))
+
     @classmethod
     def add_visitor_count(cls, sid_orig: str, visitor: StudentSession = None) -> None:
         """增加用户的总访问人数"""
         if not visitor:  # 未登录用户使用分配的user_id代替学号标识
+            if not session.get("user_id", None):  # 延迟分配模式下此时可能还没有 user_id
+                session["user_id"] = new_user_id_sequence()
             visitor_sid_orig = "anm" + str(session["user_id"])
         else:
             if sid_orig != visitor.sid_orig:  # 排除自己的访问量
@@ -876,6 +1355,108 @@ class Redis:
         """生成新的 ID（自增）"""
         return redis.incr("{}:cotc_id_sequence".format(cls.prefix))
 
+    @classmethod
+    def new_cotc_ids(cls, count: int) -> List[int]:
+        """一次生成 count 个新的 ID"""
+        last = redis.incrby("{}:cotc_id_sequence".format(cls.prefix), count)
+        return list(range(last - count + 1, last + 1))
+
+    @classmethod
+    def get_cotc_ids(cls, keys: List[Tuple[str, int, str]]) -> Dict[Tuple[str, int, str], Optional[int]]:
+        """批量获取缓存的教学班集合 ID，key 为 (course_id, teach_type, teacher_id_str)，未缓存的值为 None"""
+        res = redis.mget(["{}:cotc:{}:{}:{}".format(cls.prefix, *key) for key in keys])
+        return {key: int(cotc_id) if cotc_id is not None else None for key, cotc_id in zip(keys, res)}
+
+    @classmethod
+    def set_cotc_ids(cls, cotc_ids: Dict[Tuple[str, int, str], int]) -> None:
+        """批量缓存教学班集合 ID。教学班集合 ID 创建后不会改变，缓存一周"""
+        pipe = redis.pipeline(transaction=False)
+        for key, cotc_id in cotc_ids.items():
+            pipe.set("{}:cotc:{}:{}:{}".format(cls.prefix, *key), cotc_id, ex=7 * 86400)
+        pipe.execute()
+
+    @classmethod
+    def load_session(cls, session_id: str) -> Tuple[Optional[bytes], int]:
+        """读取服务端 session，同时返回剩余的过期时间（秒）"""
+        key = "{}:session:{}".format(cls.prefix, session_id)
+        pipe = redis.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        data, ttl = pipe.execute()
+        return data, ttl or 0
+
+    @classmethod
+    def touch_session(cls, session_id: str, ttl: int) -> None:
+        """延长服务端 session 的过期时间"""
+        redis.expire("{}:session:{}".format(cls.prefix, session_id), ttl)
+
+    @classmethod
+    def save_session(cls, session_id: str, data: bytes, ttl: int, sid_orig: str = None) -> None:
+        """保存服务端 session。已登录用户的 session ID 同时记录到该用户的 session 集合中，用于统一注销"""
+        pipe = redis.pipeline(transaction=False)
+        pipe.set("{}:session:{}".format(cls.prefix, session_id), data, ex=ttl)
+        if sid_orig:
+            user_key = "{}:user_sessions:{}".format(cls.prefix, sid_orig)
+            pipe.sadd(user_key, session_id)
+            pipe.expire(user_key, ttl)
+        pipe.execute()
+
+    @classmethod
+    def delete_session(cls, session_id: str) -> None:
+        """删除服务端 session"""
+        redis.delete("{}:session:{}".format(cls.prefix, session_id))
+
+    @classmethod
+    def revoke_user_sessions(cls, sid_orig: str) -> int:
+        """注销某个学生的所有服务端 session，返回注销的数量"""
+        user_key = "{}:user_sessions:{}".format(cls.prefix, sid_orig)
+        session_ids = [sid.decode() for sid in redis.smembers(user_key)]
+        if session_ids:
+            redis.delete(*["{}:session:{}".format(cls.prefix, sid) for sid in session_ids], user_key)
+        return len(session_ids)
+
+    @classmethod
+    def get_auth_result(cls, request_id: str) -> Optional[Tuple[bool, str]]:
+        """获得已知的教务验证结果 (success, message)，未知时返回 None"""
+        res = redis.get("{}:auth_result:{}".format(cls.prefix, request_id))
+        if res:
+            success, message = res.decode().split(",", 1)
+            return success == "1", message
+        return None
+
+    @classmethod
+    def set_auth_result(cls, request_id: str, success: bool, message: str) -> None:
+        """保存教务验证结果，供同一请求的其他查询者读取"""
+        redis.set("{}:auth_result:{}".format(cls.prefix, request_id), "{},{}".format(int(success), message),
+                  ex=SECONDS_IN_HOUR)
+
+    @classmethod
+    def acquire_auth_poll_lock(cls, request_id: str, ttl: int) -> bool:
+        """获得向 everyclass-auth 查询验证结果的锁，ttl 秒内同一个请求只有一个等待者进行查询"""
+        return bool(redis.set("{}:auth_poll_lock:{}".format(cls.prefix, request_id), 1, ex=ttl, nx=True))
+
+    @classmethod
+    def get_page(cls, cache_key: str) -> Optional[bytes]:
+        """读取页面缓存"""
+        return redis.get("{}:page:{}".format(cls.prefix, cache_key))
+
+    @classmethod
+    def set_page(cls, cache_key: str, data: str, ttl: int) -> None:
+        """写入页面缓存"""
+        redis.set("{}:page:{}".format(cls.prefix, cache_key), data, ex=ttl)
+
+    @classmethod
+    def rate_limited(cls, action: str, identity: str, limit: int, period: int) -> bool:
+        """固定窗口限流：period 秒内 identity 执行 action 超过 limit 次时返回 True"""
+        key = "{}:rate:{}:{}".format(cls.prefix, action, identity)
+        pipe = redis.pipeline(transaction=True)
+        pipe.incr(key)
+        pipe.ttl(key)
+        count, ttl = pipe.execute()
+        if ttl < 0:  # 窗口内的第一次请求
+            redis.expire(key, period)
+        return count > limit
+
     @classmethod
     def calendar_token_use_cache(cls, token: str) -> bool:
         """
@@ -920,18 +1501,26 @@ def init_mongo():
             print("[{}] Creating index...".format(cls_name))
             cls.create_index()
 
+    # 评分统计由评价增量更新，已有的评价需要重新统计一次
+    print("[CourseReviewSummary] Rebuilding...")
+    CourseReviewSummary.rebuild()
+
 
 def init_postgres():
     import inspect
     import sys
 
+    migration_tasks = []
     for cls_name, cls in inspect.getmembers(sys.modules[__name__], inspect.isclass):
         if issubclass(cls, PostgresBase) and cls is not PostgresBase:
             print("[{}] Initializing...".format(cls_name))
             cls.init()
-            if hasattr(cls, "migrate"):
-                print("[{}] Migrating...".format(cls_name))
-                cls.migrate()
+            if hasattr(cls, "migration_task"):
+                migration_tasks.append(cls.migration_task())
+
+    # 各表并行迁移
+    print("Migrating {} tables...".format(len(migration_tasks)))
+    run_migrations(migration_tasks)
 
 
 def init_db():
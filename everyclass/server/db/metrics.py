@@ -0,0 +1,215 @@
+"""
+数据库连接池与查询耗时打点
+
+- PostgreSQL：`pg_conn_context` 记录连接池等待时间、每个 DAO 方法的执行时间和返回行数
+- Redis：记录每个命令的执行时间
+- MongoDB：通过 pymongo 的监听器记录每个命令的执行时间和连接池使用情况
+
+指标通过 statsd 以 histogram 形式上报，超过 SLOW_QUERY_THRESHOLD 秒的查询会写入日志。连接池的实时使用情况可在
+`/_internal/pools` 查看。
+"""
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+import redis as redis_lib
+from pymongo import monitoring
+
+from everyclass.server import logger
+from everyclass.server.config import get_config
+
+_pool_usage: Dict[str, Dict[str, int]] = defaultdict(lambda: {"in_use": 0, "max_in_use": 0, "checkouts": 0})
+
+
+def _histogram(metric: str, value: float, tags=None) -> None:
+    from everyclass.server import statsd
+
+    if statsd:
+        statsd.histogram(metric, value, tags=tags)
+
+
+def _log_if_slow(db: str, method: str, duration: float, statement: str) -> None:
+    if duration > get_config().SLOW_QUERY_THRESHOLD:
+        logger.warning(f"Slow {db} query in {method} took {duration * 1000:.1f}ms: {statement[:200]}")
+
+
+def checkout(pool: str) -> None:
+    """记录从连接池取出一个连接"""
+    usage = _pool_usage[pool]
+    usage["in_use"] += 1
+    usage["checkouts"] += 1
+    usage["max_in_use"] = max(usage["max_in_use"], usage["in_use"])
+
+
+def checkin(pool: str) -> None:
+    """记录连接归还连接池"""
+    _pool_usage[pool]["in_use"] -= 1
+
+
+def pool_stats() -> Dict[str, Dict[str, Optional[int]]]:
+    """各连接池当前的使用情况"""
+    from everyclass.server.db.redis import redis
+
+    stats = {name: dict(usage) for name, usage in _pool_usage.items()}
+
+    # redis-py 未公开连接池的使用情况，私有属性在升级后可能不存在，此时只返回最大连接数
+    redis_pool = redis.connection_pool
+    in_use = getattr(redis_pool, "_in_use_connections", None)
+    available = getattr(redis_pool, "_available_connections", None)
+    stats["redis"] = {"in_use"   : len(in_use) if in_use is not None else None,
+                      "available": len(available) if available is not None else None,
+                      "max"      : getattr(redis_pool, "max_connections", None)}
+    return stats
+
+
+def caller_name(depth: int = 2) -> str:
+    """获得调用者的名称，DAO 方法的格式为 `类名.方法名`"""
+    frame = sys._getframe(depth + 1)
+    cls = frame.f_locals.get("cls", None)
+    if isinstance(cls, type):
+        return f"{cls.__name__}.{frame.f_code.co_name}"
+    return frame.f_code.co_name
+
+
+class PostgresTracker:
+    """统计一次 `pg_conn_context` 中所有查询的执行时间和行数"""
+
+    def __init__(self, method: str, pool: str):
+        self.method = method
+        self.pool = pool
+        self.execution_time = 0.0
+        self.rows = 0
+
+    def record(self, duration: float, rowcount: int, statement: str) -> None:
+        self.execution_time += duration
+        if rowcount and rowcount > 0:
+            self.rows += rowcount
+        _log_if_slow("postgres", self.method, duration, statement)
+
+    def report(self, checkout_wait: float) -> None:
+        tags = [f"method:{self.method}", f"pool:{self.pool}"]
+        _histogram("db.postgres.checkout_wait", checkout_wait, tags=tags)
+        _histogram("db.postgres.execution_time", self.execution_time, tags=tags)
+        _histogram("db.postgres.rows", self.rows, tags=tags)
+
+
+class InstrumentedCursor:
+    def __init__(self, cursor, tracker: PostgresTracker):
+        self._cursor = cursor
+        self._tracker = tracker
+
+    def _timed(self, func, statement, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._tracker.record(time.perf_counter() - start, self._cursor.rowcount, str(statement))
+
+    def execute(self, query, *args, **kwargs):
+        return self._timed(self._cursor.execute, query, query, *args, **kwargs)
+
+    def executemany(self, query, *args, **kwargs):
+        return self._timed(self._cursor.executemany, query, query, *args, **kwargs)
+
+    def copy_expert(self, sql, *args, **kwargs):
+        return self._timed(self._cursor.copy_expert, sql, sql, *args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self._cursor.__exit__(exc_type, exc_val, exc_tb)
+
+
+class InstrumentedConnection:
+    def __init__(self, conn, tracker: PostgresTracker):
+        self._conn = conn
+        self._tracker = tracker
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._tracker)
+
+    def __getattr__(self, item):
+        return getattr(self._conn, item)
+
+
+class InstrumentedRedis(redis_lib.Redis):
+    """记录每个命令执行时间的 Redis 客户端"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            duration = time.perf_counter() - start
+            _histogram("db.redis.execution_time", duration, tags=[f"command:{args[0]}"])
+            _log_if_slow("redis", str(args[0]), duration, " ".join(map(str, args[:2])))
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """记录 MongoDB 命令执行时间"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._report(event)
+
+    def failed(self, event):
+        self._report(event)
+
+    @staticmethod
+    def _report(event) -> None:
+        duration = event.duration_micros / 1e6
+        _histogram("db.mongodb.execution_time", duration, tags=[f"command:{event.command_name}"])
+        _log_if_slow("mongodb", event.command_name, duration, event.command_name)
+
+
+mongo_pool_listener = None
+if hasattr(monitoring, "ConnectionPoolListener"):  # pymongo >= 3.9
+    class MongoPoolListener(monitoring.ConnectionPoolListener):
+        """记录 MongoDB 连接池使用情况"""
+
+        def connection_checked_out(self, event):
+            checkout("mongodb")
+
+        def connection_checked_in(self, event):
+            checkin("mongodb")
+
+        # 其他连接池事件不需要处理
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_created(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            pass
+
+        def connection_check_out_started(self, event):
+            pass
+
+        def connection_check_out_failed(self, event):
+            pass
+
+    mongo_pool_listener = MongoPoolListener()
@@ -0,0 +1,142 @@
+"""
+MongoDB 到 PostgreSQL 的批量迁移
+
+逐条 INSERT 迁移百万级的集合需要数小时。这里使用流式游标按 `_id` 顺序分批读取 MongoDB 文档，每批通过 `COPY FROM STDIN`
+写入 PostgreSQL，并在同一事务中记录检查点（本批最后一个 `_id`），中断后再次运行会从检查点继续。多个表的迁移并行执行。
+"""
+import csv
+import datetime
+import io
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from bson import ObjectId
+
+from everyclass.server.config import get_config
+from everyclass.server.db.mongodb import get_connection as get_mongodb
+from everyclass.server.db.postgres import pg_conn_context
+
+
+class MigrationTask(NamedTuple):
+    collection: str  # MongoDB 集合名
+    table: str  # PostgreSQL 表名
+    columns: Tuple[str, ...]  # 写入的列
+    transform: Callable[[Dict], Tuple]  # 将一个 MongoDB 文档转换为一行，顺序与 columns 一致
+
+
+def _format_value(value: Any) -> Optional[str]:
+    """将 Python 值转换为 COPY CSV 格式中的文本，None 表示 NULL"""
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        # hstore
+        return ",".join('"{}"=>"{}"'.format(_escape_hstore(k), _escape_hstore(v)) for k, v in value.items())
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return str(value)
+
+
+def _escape_hstore(text: Any) -> str:
+    return str(text).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _init_checkpoint_table() -> None:
+    with pg_conn_context() as conn, conn.cursor() as cursor:
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS migration_checkpoints
+            (
+                table_name character varying(63) NOT NULL PRIMARY KEY,
+                last_id character varying(24) NOT NULL,
+                rows bigint NOT NULL,
+                update_time timestamp with time zone NOT NULL
+            )
+            WITH (
+                OIDS = FALSE
+            );
+        """
+        cursor.execute(create_table_query)
+        conn.commit()
+
+
+def _get_checkpoint(table: str) -> Tuple[Optional[str], int]:
+    """获得某个表的检查点，返回最后迁移的 `_id` 和已迁移行数"""
+    with pg_conn_context() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT last_id, rows FROM migration_checkpoints WHERE table_name=%s", (table,))
+        result = cursor.fetchone()
+    return (result[0], result[1]) if result else (None, 0)
+
+
+def _copy_batch(task: MigrationTask, rows: List[Tuple], last_id: str, total: int) -> None:
+    """使用 COPY 写入一批数据，并在同一事务中更新检查点"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([_format_value(v) for v in row])
+    buffer.seek(0)
+
+    with pg_conn_context() as conn, conn.cursor() as cursor:
+        cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(task.table, ", ".join(task.columns)),
+                           buffer)
+        checkpoint_query = """
+        INSERT INTO migration_checkpoints (table_name, last_id, rows, update_time) VALUES (%s,%s,%s,%s)
+            ON CONFLICT (table_name) DO UPDATE SET last_id=EXCLUDED.last_id, rows=EXCLUDED.rows,
+                                                   update_time=EXCLUDED.update_time
+        """
+        cursor.execute(checkpoint_query, (task.table, last_id, total, datetime.datetime.now()))
+        conn.commit()
+
+
+def migrate(task: MigrationTask) -> int:
+    """
+    迁移一个集合，可从检查点继续
+
+    :return: 该表累计迁移的行数
+    """
+    batch_size = get_config().MIGRATION_BATCH_SIZE
+    last_id, total = _get_checkpoint(task.table)
+    if last_id:
+        print("[{}] Resuming from checkpoint {} ({} rows migrated)".format(task.table, last_id, total))
+
+    query = {"_id": {"$gt": ObjectId(last_id)}} if last_id else {}
+    cursor = get_mongodb().get_collection(task.collection).find(query).sort("_id", 1).batch_size(batch_size)
+
+    start_time = time.time()
+    migrated = 0
+    rows: List[Tuple] = []
+    for doc in cursor:
+        rows.append(task.transform(doc))
+        if len(rows) >= batch_size:
+            total += len(rows)
+            migrated += len(rows)
+            _copy_batch(task, rows, str(doc["_id"]), total)
+            rows = []
+            _report(task.table, total, migrated, start_time)
+    if rows:
+        total += len(rows)
+        migrated += len(rows)
+        _copy_batch(task, rows, str(doc["_id"]), total)
+
+    _report(task.table, total, migrated, start_time, finished=True)
+    return total
+
+
+def _report(table: str, total: int, migrated: int, start_time: float, finished: bool = False) -> None:
+    """打印迁移进度和吞吐量"""
+    elapsed = max(time.time() - start_time, 0.001)
+    print("[{}] {} {} rows in total, {:.0f} rows/s".format(table,
+                                                           "Migration finished." if finished else "Migrating...",
+                                                           total,
+                                                           migrated / elapsed))
+
+
+def run_migrations(tasks: Iterable[MigrationTask]) -> Dict[str, int]:
+    """并行执行多个迁移任务，返回每个表累计迁移的行数"""
+    tasks = list(tasks)
+    _init_checkpoint_table()
+    with ThreadPoolExecutor(max_workers=get_config().MIGRATION_WORKERS) as executor:
+        results = executor.map(migrate, tasks)
+        return {task.table: count for task, count in zip(tasks, results)}
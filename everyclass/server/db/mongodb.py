@@ -1,17 +1,42 @@
-from flask import current_app, has_app_context
+import os
+import threading
+
 from pymongo import MongoClient, database
 
 from everyclass.server.config import get_config
+from everyclass.server.db.metrics import MongoCommandListener, mongo_pool_listener
+
+_client = None  # 进程级客户端，请求、命令行、定时任务和后台任务共用
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _event_listeners():
+    """MongoDB 命令及连接池打点"""
+    return [MongoCommandListener()] + ([mongo_pool_listener] if mongo_pool_listener else [])
+
+
+def reset_client() -> None:
+    """丢弃进程级客户端，在 fork 后调用。MongoClient 不是 fork 安全的，子进程需要重新创建"""
+    global _client, _client_pid
+    with _client_lock:
+        _client = None
+        _client_pid = None
 
 
-def init_pool(current_application) -> None:
-    """创建连接池，保存在 app 的 mongo 属性中"""
-    current_application.mongo = MongoClient(**current_application.config['MONGODB'])
+def _get_client() -> MongoClient:
+    """获得进程级客户端，首次使用时创建。如果检测到进程已 fork，则重新创建"""
+    global _client, _client_pid
+    if _client is not None and _client_pid == os.getpid():
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            # connect=False：首次操作时才建立连接，避免在 fork 前连接
+            _client = MongoClient(**get_config().MONGODB, connect=False, event_listeners=_event_listeners())
+            _client_pid = os.getpid()
+        return _client
 
 
 def get_connection() -> database.Database:
     """在连接池中获得连接"""
-    if not has_app_context():
-        config = get_config()
-        return MongoClient(**config.MONGODB).get_database(config.MONGODB_DB)
-    return current_app.mongo.get_database(current_app.config['MONGODB_DB'])
+    return _get_client().get_database(get_config().MONGODB_DB)
@@ -1,18 +1,158 @@
+import re
+import time
+import weakref
 from contextlib import contextmanager
+from typing import Set, Tuple
 
+from flask import has_request_context, session
+
+from everyclass.server import logger
 from everyclass.server.config import get_config
+from everyclass.server.consts import SESSION_READ_PRIMARY_UNTIL
+from everyclass.server.db.metrics import InstrumentedConnection, PostgresTracker, caller_name, checkin, checkout
 
 _config = get_config()
+_replica_pool = None
+_replica_hstore_registered = False
+_prepared: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # 连接 -> (backend pid, 已预备的语句名称)
 
 
 def init_pool() -> None:
-    """创建连接池"""
+    """创建连接池。如果配置了只读副本，另外创建副本连接池"""
     from everyclass.common.postgres import init_pool as init
     init(_config.POSTGRES_SCHEMA, _config.POSTGRES_CONNECTION)
 
+    global _replica_pool
+    if _config.POSTGRES_REPLICA_CONNECTION:
+        import psycopg2
+        from DBUtils.PooledDB import PooledDB
+
+        _replica_pool = PooledDB(psycopg2,
+                                 maxconnections=_config.POSTGRES_REPLICA_POOL_SIZE,
+                                 options=f"-c search_path={_config.POSTGRES_SCHEMA}",
+                                 **_config.POSTGRES_REPLICA_CONNECTION)
+
+
+@contextmanager
+def pg_conn_context(read_only: bool = False):
+    """
+    获得数据库连接
+
+    :param read_only: 只读查询。配置了只读副本时会使用副本连接，副本不可用或当前用户刚刚写入过数据（见 `mark_written`）时使用主库
+    """
+    method = caller_name(depth=2)  # 跳过 contextmanager 的 __enter__，得到 DAO 方法名
+    start = time.perf_counter()
+    with _conn_context(read_only) as (conn, pool):
+        checkout_wait = time.perf_counter() - start
+        tracker = PostgresTracker(method, pool)
+        checkout(f"postgres.{pool}")
+        try:
+            yield InstrumentedConnection(conn, tracker)
+        finally:
+            checkin(f"postgres.{pool}")
+            tracker.report(checkout_wait)
+
 
 @contextmanager
-def pg_conn_context():
+def _conn_context(read_only: bool):
+    """获得连接，同时返回连接所属的连接池名称"""
+    if read_only and _replica_pool and not _in_read_your_writes_window():
+        conn = _get_replica_connection()
+        if conn:
+            try:
+                yield conn, "replica"
+            finally:
+                conn.close()  # 归还连接池
+            return
+
     from everyclass.common.postgres import conn_context_with_retry as context
     with context() as conn:
-        yield conn
+        yield conn, "primary"
+
+
+def _get_replica_connection():
+    """从副本连接池获得连接，失败时返回 None"""
+    import psycopg2
+    from psycopg2.extras import register_hstore
+
+    global _replica_hstore_registered
+    try:
+        conn = _replica_pool.connection()
+        if not _replica_hstore_registered:
+            with conn.cursor() as cursor:
+                register_hstore(cursor, globally=True)
+            _replica_hstore_registered = True
+        return conn
+    except psycopg2.OperationalError:
+        logger.warning("Read replica not available, fall back to primary.")
+        return None
+
+
+def mark_written() -> None:
+    """
+    标记当前用户刚刚写入了数据。在 POSTGRES_READ_YOUR_WRITES_WINDOW 秒内，该用户的只读查询都会发往主库，避免因副本延迟读不到自己的写入
+    """
+    if has_request_context():
+        session[SESSION_READ_PRIMARY_UNTIL] = time.time() + _config.POSTGRES_READ_YOUR_WRITES_WINDOW
+
+
+def _in_read_your_writes_window() -> bool:
+    return has_request_context() and session.get(SESSION_READ_PRIMARY_UNTIL, 0) > time.time()
+
+
+def _prepared_names(conn) -> Set[str]:
+    """
+    获得连接上已经 PREPARE 过的语句名称。记录以连接对象为弱引用键，连接关闭后自动删除；连接池重建连接后 backend pid 改变，记录随之清空
+    """
+    pid = conn.get_backend_pid()
+    entry = _prepared.get(conn, None)
+    if entry is None or entry[0] != pid:
+        entry = (pid, set())
+        _prepared[conn] = entry
+    return entry[1]
+
+
+class PreparedStatement:
+    """
+    预备语句
+
+    同一条 SQL 在每个连接上只 PREPARE 一次，之后通过 EXECUTE 按名称执行，省去 PostgreSQL 重复解析和生成执行计划的开销。
+    查询中的占位符与普通查询一样使用 `%s`。POSTGRES_PREPARED_STATEMENTS 为 False 时退化为普通查询。
+    """
+
+    def __init__(self, name: str, query: str):
+        self.name = name
+        self.query = query
+        self._param_count = query.count("%s")
+        placeholders = iter(range(1, self._param_count + 1))
+        self._prepare_query = f"PREPARE {name} AS " + re.sub(r"%s", lambda _: f"${next(placeholders)}", query)
+        self._execute_query = f"EXECUTE {name}" + (f"({','.join(['%s'] * self._param_count)})"
+                                                   if self._param_count else "")
+
+    def execute(self, cursor, params: Tuple = ()) -> None:
+        """在 cursor 上执行本语句"""
+        import psycopg2.errors
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+        if not _config.POSTGRES_PREPARED_STATEMENTS:
+            cursor.execute(self.query, params)
+            return
+
+        conn = cursor.connection
+        prepared = _prepared_names(conn)
+        # 本语句是否为事务中的第一条语句。只有这种情况下回滚不会丢失调用者之前执行的语句
+        first_in_transaction = conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        if self.name not in prepared:
+            cursor.execute(self._prepare_query)
+            prepared.add(self.name)
+        try:
+            cursor.execute(self._execute_query, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # 预备语句在服务端已失效（例如连接被 DISCARD ALL）
+            prepared.clear()
+            if not first_in_transaction:
+                raise
+            conn.rollback()
+            cursor.execute(self._prepare_query)
+            prepared.add(self.name)
+            cursor.execute(self._execute_query, params)
@@ -1,6 +1,5 @@
-import redis
-
 from everyclass.server.config import get_config
+from everyclass.server.db.metrics import InstrumentedRedis
 
 config = get_config()
-redis = redis.Redis(**config.REDIS)
+redis = InstrumentedRedis(**config.REDIS)
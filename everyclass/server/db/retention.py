@@ -0,0 +1,73 @@
+"""
+过期数据清理
+
+`simple_passwords`、`identity_verify_requests` 只增不减，长期不用的 `calendar_tokens` 也会一直保留，表和索引越来越大。
+清理任务在凌晨低峰期运行，按 RETENTION 配置的保留天数分批删除过期数据，每批之间暂停一段时间以免影响线上查询。
+删除日历令牌时，如果对应的资源已没有其他令牌，同时删除 ics 缓存文件。
+"""
+import datetime
+import os
+import time
+from typing import Callable, Dict
+
+from everyclass.server import logger
+from everyclass.server.config import get_config
+from everyclass.server.db.dao import CalendarToken, IdentityVerification, SimplePassword
+from everyclass.server.utils import calendar_dir
+
+
+def _purge_in_batches(table: str, purge_batch: Callable[[datetime.datetime, int], int], deadline: float) -> int:
+    """按批次删除，直到没有过期数据或到达截止时间。返回删除的总行数"""
+    config = get_config()
+    days = config.RETENTION[table]
+    if days is None:
+        return 0
+    before = datetime.datetime.now() - datetime.timedelta(days=days)
+
+    total = 0
+    while time.time() < deadline:
+        count = purge_batch(before, config.RETENTION_BATCH_SIZE)
+        total += count
+        if count < config.RETENTION_BATCH_SIZE:
+            break
+        time.sleep(config.RETENTION_BATCH_INTERVAL)
+    else:
+        logger.warning(f"Retention job for {table} stopped before finishing because the time limit is reached.")
+    return total
+
+
+def _purge_calendar_tokens(before: datetime.datetime, limit: int) -> int:
+    tokens = CalendarToken.purge_stale(before, limit)
+    resources = {(token['type'], token['identifier'], token['semester']) for token in tokens}
+    # 同一资源可能还有其他未过期的令牌在使用同一个 ics 文件
+    resources -= CalendarToken.referenced_resources(list(resources))
+
+    cal_dir = calendar_dir()
+    for typ, identifier, semester in resources:
+        cal_full_path = os.path.join(cal_dir, f"{typ}_{identifier}_{semester}.ics")
+        try:
+            os.remove(cal_full_path)
+        except FileNotFoundError:
+            pass
+    return len(tokens)
+
+
+def run() -> Dict[str, int]:
+    """
+    执行一次清理
+
+    :return: 每个表删除的行数
+    """
+    from everyclass.server import statsd
+
+    deadline = time.time() + get_config().RETENTION_MAX_DURATION
+    report = {"simple_passwords"        : _purge_in_batches("simple_passwords", SimplePassword.purge, deadline),
+              "identity_verify_requests": _purge_in_batches("identity_verify_requests", IdentityVerification.purge,
+                                                            deadline),
+              "calendar_tokens"         : _purge_in_batches("calendar_tokens", _purge_calendar_tokens, deadline)}
+
+    for table, count in report.items():
+        if statsd:
+            statsd.gauge("db.retention.purged", count, tags=[f"table:{table}"])
+    logger.info(f"Retention job finished: {report}")
+    return report
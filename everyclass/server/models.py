@@ -1,5 +1,7 @@
 import re
-from typing import NamedTuple
+from typing import Iterator, List, NamedTuple, Tuple
+
+from everyclass.common.time import lesson_string_to_tuple
 
 
 class Semester(object):
@@ -70,3 +72,73 @@ class StudentSession(NamedTuple):
     sid_orig: str
     sid: str
     name: str
+
+
+class StudentProfile(NamedTuple):
+    """学生基本信息缓存，字段名与 `Entity.get_student` 的返回值一致"""
+    student_id: str
+    student_id_encoded: str
+    name: str
+    klass: str
+    semesters: List[str]
+
+
+def weeks_to_mask(weeks: List[int]) -> int:
+    """周次列表转换为位图，第 n 周对应第 n-1 位"""
+    mask = 0
+    for week in weeks:
+        mask |= 1 << (week - 1)
+    return mask
+
+
+def mask_to_weeks(mask: int) -> List[int]:
+    """位图转换为周次列表"""
+    weeks = []
+    week = 1
+    while mask:
+        if mask & 1:
+            weeks.append(week)
+        mask >>= 1
+        week += 1
+    return weeks
+
+
+class TimetableGrid:
+    """
+    课表的紧凑表示，由 RPC 返回的课程列表生成一次，供各查询页面、日历导出和 API 共用
+
+    - `slots[day - 1][time - 1]` 为星期 day 第 time 大节的课程在 `cards` 中的下标（7×6）
+    - `week_masks[i]` 为 `cards[i]` 的上课周次位图
+    - `empty_sat`、`empty_sun`、`empty_5`、`empty_6` 表示周六、周日、第五大节、第六大节是否没有课
+    """
+    __slots__ = ("cards", "slots", "week_masks", "empty_sat", "empty_sun", "empty_5", "empty_6")
+
+    def __init__(self, cards: list):
+        self.cards = list(cards)
+        self.slots: List[List[List[int]]] = [[[] for _ in range(6)] for _ in range(7)]
+        self.week_masks: List[int] = []
+
+        day_mask = time_mask = 0
+        for i, card in enumerate(self.cards):
+            day, time = lesson_string_to_tuple(card.lesson)
+            self.slots[day - 1][time - 1].append(i)
+            self.week_masks.append(weeks_to_mask(card.weeks))
+            day_mask |= 1 << (day - 1)
+            time_mask |= 1 << (time - 1)
+
+        self.empty_sat = not day_mask & (1 << 5)
+        self.empty_sun = not day_mask & (1 << 6)
+        self.empty_5 = not time_mask & (1 << 4)
+        self.empty_6 = not time_mask & (1 << 5)
+
+    def __getitem__(self, lesson: Tuple[int, int]) -> list:
+        """按 (星期, 大节) 获得课程列表"""
+        day, time = lesson
+        return [self.cards[i] for i in self.slots[day - 1][time - 1]]
+
+    def lessons(self) -> Iterator[Tuple[int, int, object, int]]:
+        """按大节、星期的顺序遍历所有课程，返回 (星期, 大节, 课程, 周次位图)"""
+        for time in range(1, 7):
+            for day in range(1, 8):
+                for i in self.slots[day - 1][time - 1]:
+                    yield day, time, self.cards[i], self.week_masks[i]
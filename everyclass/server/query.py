@@ -1,20 +1,21 @@
 """
 查询相关函数
 """
-from collections import defaultdict
-from typing import Dict, List, Tuple
+import re
+from typing import Dict
 
 from ddtrace import tracer
-from flask import Blueprint, current_app as app, escape, flash, redirect, render_template, request, session, url_for
+from flask import Blueprint, Markup, current_app as app, escape, flash, make_response, redirect, render_template, \
+    request, session, url_for
 
 from everyclass.common.format import contains_chinese
 from everyclass.common.time import get_day_chinese, get_time_chinese, lesson_string_to_tuple
 from everyclass.rpc.entity import Entity
 from everyclass.server import logger
 from everyclass.server.consts import MSG_INVALID_IDENTIFIER, SESSION_CURRENT_USER, SESSION_LAST_VIEWED_STUDENT
-from everyclass.server.db.dao import Redis
-from everyclass.server.models import StudentSession
-from everyclass.server.utils import semester_calculate
+from everyclass.server.db.dao import COTeachingClass, CourseReviewSummary, PrivacySettings, Redis
+from everyclass.server.models import StudentSession, TimetableGrid
+from everyclass.server.utils import page_cache, semester_calculate
 from everyclass.server.utils.access_control import check_permission
 from everyclass.server.utils.decorators import disallow_in_maintenance, url_semester_check
 from everyclass.server.utils.resource_identifier_encrypt import decrypt
@@ -101,10 +102,14 @@ def query():
         else:
             tracer.current_root_span().set_tag("query_type", "by_id")
 
+        with tracer.trace('get_privacy_settings'):
+            privacy_levels = PrivacySettings.get_levels([student.student_id for student in rpc_result.students])
+
         return render_template('query/peopleWithSameName.html',
                                name=keyword,
                                students=rpc_result.students,
-                               teachers=rpc_result.teachers)
+                               teachers=rpc_result.teachers,
+                               privacy_levels=privacy_levels)
     else:
         logger.info("No result for user search", extra={"keyword": request.values.get('id')})
         tracer.current_root_span().set_tag("query_resource_type", "not_exist")
@@ -125,6 +130,16 @@ def get_student(url_sid: str, url_semester: str):
     except ValueError:
         return render_template("common/error.html", message=MSG_INVALID_IDENTIFIER)
 
+    # 匿名访问公开用户的课表时使用页面缓存。命中缓存时仍需记录最后浏览的学生和访客
+    cache_key = page_cache.key() if page_cache.cacheable() else None
+    if cache_key:
+        cached = page_cache.load(cache_key)
+        if cached and PrivacySettings.get_level(student_id) == 0:
+            body, meta = cached
+            session[SESSION_LAST_VIEWED_STUDENT] = StudentSession(**meta["student"])
+            Redis.add_visitor_count(student_id, None)
+            return page_cache.with_cache_headers(make_response(_fill_ratings(body, meta["cotc_ids"])), public=False)
+
     # RPC 获得学生课表
     with tracer.trace('rpc_get_student_timetable'):
         try:
@@ -143,28 +158,22 @@ def get_student(url_sid: str, url_semester: str):
     if not has_permission:
         return return_val
 
-    with tracer.trace('process_rpc_result'):
-        cards: Dict[Tuple[int, int], List[Dict[str, str]]] = dict()
-        for card in student.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            if (day, time) not in cards:
-                cards[(day, time)] = list()
-            cards[(day, time)].append(card)
-        empty_5, empty_6, empty_sat, empty_sun = _empty_column_check(cards)
-        available_semesters = semester_calculate(url_semester, sorted(student.semesters))
+    available_semesters = semester_calculate(url_semester, sorted(student.semesters))
 
     # 增加访客记录
     Redis.add_visitor_count(student.student_id, session.get(SESSION_CURRENT_USER, None))
 
-    return render_template('query/student.html',
+    cotc_ids = _cotc_ids(student.cards)
+    body = render_template('query/student.html',
                            student=student,
-                           cards=cards,
-                           empty_sat=empty_sat,
-                           empty_sun=empty_sun,
-                           empty_6=empty_6,
-                           empty_5=empty_5,
+                           timetable_grid=_timetable_grid("student", student.student_id, url_semester, student.cards),
                            available_semesters=available_semesters,
                            current_semester=url_semester)
+    if cache_key and PrivacySettings.get_level(student.student_id) == 0:
+        page_cache.store(cache_key, body, {"student" : session[SESSION_LAST_VIEWED_STUDENT]._asdict(),
+                                           "cotc_ids": cotc_ids})
+        return page_cache.with_cache_headers(make_response(_fill_ratings(body, cotc_ids)), public=False)
+    return _fill_ratings(body, cotc_ids)
 
 
 @query_blueprint.route('/teacher/<string:url_tid>/<string:url_semester>')
@@ -186,27 +195,14 @@ def get_teacher(url_tid, url_semester):
         except Exception as e:
             return handle_exception_with_error_page(e)
 
-    with tracer.trace('process_rpc_result'):
-        cards = defaultdict(list)
-        for card in teacher.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            if (day, time) not in cards:
-                cards[(day, time)] = list()
-            cards[(day, time)].append(card)
-
-    empty_5, empty_6, empty_sat, empty_sun = _empty_column_check(cards)
-
     available_semesters = semester_calculate(url_semester, teacher.semesters)
 
-    return render_template('query/teacher.html',
+    body = render_template('query/teacher.html',
                            teacher=teacher,
-                           cards=cards,
-                           empty_sat=empty_sat,
-                           empty_sun=empty_sun,
-                           empty_6=empty_6,
-                           empty_5=empty_5,
+                           timetable_grid=_timetable_grid("teacher", teacher_id, url_semester, teacher.cards),
                            available_semesters=available_semesters,
                            current_semester=url_semester)
+    return _fill_ratings(body, _cotc_ids(teacher.cards))
 
 
 @query_blueprint.route('/classroom/<string:url_rid>/<string:url_semester>')
@@ -227,25 +223,14 @@ def get_classroom(url_rid, url_semester):
         except Exception as e:
             return handle_exception_with_error_page(e)
 
-    with tracer.trace('process_rpc_result'):
-        cards = defaultdict(list)
-        for card in room.cards:
-            day, time = lesson_string_to_tuple(card.lesson)
-            cards[(day, time)].append(card)
-
-    empty_5, empty_6, empty_sat, empty_sun = _empty_column_check(cards)
-
     available_semesters = semester_calculate(url_semester, room.semesters)
 
-    return render_template('query/room.html',
+    body = render_template('query/room.html',
                            room=room,
-                           cards=cards,
-                           empty_sat=empty_sat,
-                           empty_sun=empty_sun,
-                           empty_6=empty_6,
-                           empty_5=empty_5,
+                           timetable_grid=_timetable_grid("room", room_id, url_semester, room.cards),
                            available_semesters=available_semesters,
                            current_semester=url_semester)
+    return _fill_ratings(body, _cotc_ids(room.cards))
 
 
 @query_blueprint.route('/card/<string:url_cid>/<string:url_semester>')
@@ -272,43 +257,87 @@ def get_card(url_cid: str, url_semester: str):
     if card.type and card.type[-1] != '课':
         card.type = card.type + '课'
 
-    # cotc_id = COTeachingClass.get_id_by_card(card)
-    # course_review_doc = CourseReview.get_review(cotc_id)
+    with tracer.trace('get_privacy_settings'):
+        privacy_levels = PrivacySettings.get_levels([student.student_id for student in card.students])
+
+    cotc_rating = _cotc_ratings(_cotc_ids([card])).get(card.card_id_encoded, {"cotc_id": 0, "avg_rate": 0})
 
     return render_template('query/card.html',
                            card=card,
                            card_day=get_day_chinese(day),
                            card_time=get_time_chinese(time),
                            show_union_class=not card.union_name.isdigit(),  # 合班名称为数字时不展示合班名称
-                           # cotc_id=cotc_id,
-                           # cotc_rating=course_review_doc["avg_rate"],
-                           cotc_id=0,
-                           cotc_rating=0,
+                           cotc_id=cotc_rating["cotc_id"],
+                           cotc_rating=cotc_rating["avg_rate"],
+                           privacy_levels=privacy_levels,
                            current_semester=url_semester
                            )
 
 
-def _empty_column_check(cards: dict) -> Tuple[bool, bool, bool, bool]:
-    """检查是否周末和晚上有课，返回三个布尔值"""
-    with tracer.trace('_empty_column_check'):
-        # 空闲周末判断，考虑到大多数人周末都是没有课程的
-        empty_sat = True
-        for cls_time in range(1, 7):
-            if (6, cls_time) in cards:
-                empty_sat = False
-
-        empty_sun = True
-        for cls_time in range(1, 7):
-            if (7, cls_time) in cards:
-                empty_sun = False
-
-        # 空闲课程判断，考虑到大多数人11-12节都是没有课程的
-        empty_6 = True
-        for cls_day in range(1, 8):
-            if (cls_day, 6) in cards:
-                empty_6 = False
-        empty_5 = True
-        for cls_day in range(1, 8):
-            if (cls_day, 5) in cards:
-                empty_5 = False
-    return empty_5, empty_6, empty_sat, empty_sun
+def _cotc_ids(cards: list) -> Dict[str, int]:
+    """
+    批量获得课程对应的教学班集合 ID，以 card_id_encoded 为键。课程评价功能未开启时返回空字典
+    """
+    if not app.config['FEATURE_GATING']['course_review'] or not cards:
+        return {}
+
+    with tracer.trace('get_cotc_ids'):
+        cotc_ids = COTeachingClass.get_ids_by_cards(cards)
+    return {card.card_id_encoded: cotc_id for card, cotc_id in zip(cards, cotc_ids)}
+
+
+def _cotc_ratings(cotc_ids: Dict[str, int]) -> Dict[str, Dict]:
+    """
+    批量获得评分统计，以 card_id_encoded 为键，包含教学班集合 ID。评分随新的评价变化，不缓存
+    """
+    if not cotc_ids:
+        return {}
+
+    with tracer.trace('get_cotc_ratings'):
+        summaries = CourseReviewSummary.get_many(list(cotc_ids.values()))
+    return {card_id: dict(summaries[cotc_id], cotc_id=cotc_id) for card_id, cotc_id in cotc_ids.items()}
+
+
+_RATING_PLACEHOLDER = re.compile(r'<!--rating:(.+?)-->')
+
+
+def _fill_ratings(body: str, cotc_ids: Dict[str, int]) -> str:
+    """将课表表格中的评分占位符替换为评分链接"""
+    cotc_ratings = _cotc_ratings(cotc_ids)
+
+    def rating_link(match) -> str:
+        rating = cotc_ratings.get(match.group(1), {})
+        if not rating.get("count"):
+            return ""
+        url = url_for('course_review.show_review', cotc_id=rating["cotc_id"])
+        return str(Markup('<a href="{}">评分 {}</a>').format(url, rating["avg_rate"]))
+
+    return _RATING_PLACEHOLDER.sub(rating_link, body)
+
+
+def _timetable_grid(resource_type: str, identifier: str, semester: str, cards: list) -> Markup:
+    """
+    渲染课表表格。表格与访问者无关，按资源、学期和数据版本缓存，命中缓存时不再整理课程。
+    表格中的评分只是占位符，页面输出前由 `_fill_ratings` 填入，因此评分不会进入表格缓存和整页缓存
+
+    :param resource_type: student、teacher 或 room
+    :param identifier: 资源标识符（未加密）
+    :param semester: 学期
+    :param cards: RPC 返回的课程列表
+    """
+    cache_key = page_cache.fragment_key("timetable", resource_type, identifier, semester)
+    if app.config['PAGE_CACHE_ENABLED']:
+        cached = page_cache.load(cache_key)
+        if cached:
+            return Markup(cached[0])
+
+    with tracer.trace('process_rpc_result'):
+        timetable = TimetableGrid(cards)
+
+    grid = render_template('query/timetable_grid.html',
+                           resource_type=resource_type,
+                           timetable=timetable,
+                           current_semester=semester)
+    if app.config['PAGE_CACHE_ENABLED']:
+        page_cache.store(cache_key, grid)
+    return Markup(grid)
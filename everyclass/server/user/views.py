@@ -1,12 +1,13 @@
+from typing import Tuple
+
 from ddtrace import tracer
 from flask import Blueprint, flash, jsonify, redirect, render_template, request, session, url_for
-from zxcvbn import zxcvbn
 
 from everyclass.rpc import RpcResourceNotFound
 from everyclass.rpc.auth import Auth
-from everyclass.rpc.entity import Entity
 from everyclass.rpc.tencent_captcha import TencentCaptcha
 from everyclass.server import logger
+from everyclass.server.config import get_config
 from everyclass.server.consts import MSG_400, MSG_ALREADY_REGISTERED, MSG_EMPTY_PASSWORD, MSG_EMPTY_USERNAME, \
     MSG_INTERNAL_ERROR, MSG_INVALID_CAPTCHA, MSG_NOT_REGISTERED, MSG_PWD_DIFFERENT, MSG_REGISTER_SUCCESS, \
     MSG_TOKEN_INVALID, MSG_USERNAME_NOT_EXIST, MSG_VIEW_SCHEDULE_FIRST, MSG_WEAK_PASSWORD, MSG_WRONG_PASSWORD, \
@@ -16,19 +17,19 @@ from everyclass.server.db.dao import CalendarToken, ID_STATUS_PASSWORD_SET, ID_S
     ID_STATUS_TKN_PASSED, ID_STATUS_WAIT_VERIFY, IdentityVerification, PrivacySettings, Redis, \
     SimplePassword, User, VisitTrack
 from everyclass.server.models import StudentSession
+from everyclass.server.utils import password_strength
 from everyclass.server.utils.decorators import login_required
-from everyclass.server.utils.rpc import handle_exception_with_error_page
+from everyclass.server.utils.rpc import get_student_profile, handle_exception_with_error_page
 
 user_bp = Blueprint('user', __name__)
 
 
 def _session_save_student_to_register_(student_id: str):
     # 将需要注册的用户并保存到 SESSION_STUDENT_TO_REGISTER
-    with tracer.trace('rpc_get_student'):
-        try:
-            student = Entity.get_student(student_id)
-        except Exception as e:
-            return handle_exception_with_error_page(e)
+    try:
+        student = get_student_profile(student_id)
+    except Exception as e:
+        return handle_exception_with_error_page(e)
 
     session[SESSION_STUDENT_TO_REGISTER] = StudentSession(sid_orig=student.student_id,
                                                           sid=student.student_id_encoded,
@@ -64,7 +65,7 @@ def login():
 
             # 检查学号是否存在
             try:
-                Entity.get_student(student_id)
+                get_student_profile(student_id)
             except RpcResourceNotFound:
                 flash(MSG_USERNAME_NOT_EXIST)
                 return redirect(url_for("user.login"))
@@ -88,7 +89,7 @@ def login():
 
         if success:
             try:
-                student = Entity.get_student(student_id)
+                student = get_student_profile(student_id)
             except Exception as e:
                 return handle_exception_with_error_page(e)
 
@@ -182,8 +183,7 @@ def email_verification():
         sid_orig = req['sid_orig']
 
         # 密码强度检查
-        pwd_strength_report = zxcvbn(password=request.form["password"])
-        if pwd_strength_report['score'] < 2:
+        if password_strength.score(request.form["password"], exact=True) < password_strength.WEAK_SCORE:
             SimplePassword.new(password=request.form["password"], sid_orig=sid_orig)
             flash(MSG_WEAK_PASSWORD)
             return redirect(url_for("user.email_verification"))
@@ -200,7 +200,7 @@ def email_verification():
 
         # 查询 api-server 获得学生基本信息
         try:
-            student = Entity.get_student(sid_orig)
+            student = get_student_profile(sid_orig)
         except Exception as e:
             return handle_exception_with_error_page(e)
 
@@ -255,8 +255,7 @@ def register_by_password():
             return redirect(url_for("user.register_by_password"))
 
         # 密码强度检查
-        pwd_strength_report = zxcvbn(password=request.form["password"])
-        if pwd_strength_report['score'] < 2:
+        if password_strength.score(request.form["password"], exact=True) < password_strength.WEAK_SCORE:
             SimplePassword.new(password=request.form["password"],
                                sid_orig=session[SESSION_STUDENT_TO_REGISTER].sid_orig)
             flash(MSG_WEAK_PASSWORD)
@@ -299,20 +298,43 @@ def register_by_password():
 def password_strength_check():
     """AJAX 密码强度检查"""
     if request.form.get("password", None):
+        # 限流：前端在输入时就会请求
+        identity = session.get("user_id", None) or request.remote_addr
+        period = get_config().PASSWORD_STRENGTH_CHECK_PERIOD
+        if Redis.rate_limited("pwd_strength", identity, get_config().PASSWORD_STRENGTH_CHECK_LIMIT, period):
+            return jsonify({"rate_limited": True, "retry_after": period}), 429
+
         # 密码强度检查
-        pwd_strength_report = zxcvbn(password=request.form["password"])
-        if pwd_strength_report['score'] < 2:
-            return jsonify({"strong": False,
-                            "score" : pwd_strength_report['score']})
-        else:
-            return jsonify({"strong": True,
-                            "score" : pwd_strength_report['score']})
+        score = password_strength.score(request.form["password"])
+        return jsonify({"strong": score >= password_strength.WEAK_SCORE,
+                        "score" : score})
     return jsonify({"invalid_request": True})
 
 
+def _poll_auth_result(request_id: str) -> Tuple[bool, str]:
+    """
+    查询 everyclass-auth 的验证结果，返回 (success, message)，尚无结果时返回 (False, "NEXT_TIME")，不阻塞请求线程
+
+    同一个请求可能有多个查询者（多个标签页、多个 worker）。最终结果保存在 Redis 中共享；通过 Redis 锁保证每
+    REGISTER_STATUS_POLL_INTERVAL 秒内只有一个查询者调用 `Auth.get_result`。
+    """
+    result = Redis.get_auth_result(request_id)
+    if result:
+        return result
+
+    if Redis.acquire_auth_poll_lock(request_id, get_config().REGISTER_STATUS_POLL_INTERVAL):
+        with tracer.trace('get_result'):
+            rpc_result = Auth.get_result(request_id)
+        logger.info(f"RPC result: {rpc_result}")
+        if rpc_result.success or rpc_result.message in ("PASSWORD_WRONG", "INTERNAL_ERROR", "INVALID_REQUEST_ID"):
+            Redis.set_auth_result(request_id, rpc_result.success, rpc_result.message)
+            return rpc_result.success, rpc_result.message
+    return False, "NEXT_TIME"
+
+
 @user_bp.route('/register/byPassword/statusRefresh')
 def register_by_password_status():
-    """AJAX 刷新教务验证状态"""
+    """AJAX 轮询教务验证状态，立即返回。尚无结果时返回 NEXT_TIME 及建议的下次查询间隔"""
     if not request.args.get("request", None) or not isinstance(request.args["request"], str):
         return "Invalid request"
     req = IdentityVerification.get_request_by_id(request.args.get("request"))
@@ -322,22 +344,20 @@ def register_by_password_status():
         logger.warn("Non-password verification request is trying get status from password interface")
         return "Invalid request"
 
-    # fetch status from everyclass-auth
-    with tracer.trace('get_result'):
-        try:
-            rpc_result = Auth.get_result(str(request.args.get("request")))
-        except Exception as e:
-            return handle_exception_with_error_page(e)
-        logger.info(f"RPC result: {rpc_result}")
+    # get status from everyclass-auth
+    try:
+        success, message = _poll_auth_result(str(request.args.get("request")))
+    except Exception as e:
+        return handle_exception_with_error_page(e)
 
-    if rpc_result.success:  # 密码验证通过，设置请求状态并新增用户
+    if success:  # 密码验证通过，设置请求状态并新增用户
         IdentityVerification.set_request_status(str(request.args.get("request")), ID_STATUS_PWD_SUCCESS)
 
         verification_req = IdentityVerification.get_request_by_id(str(request.args.get("request")))
 
         # 从 api-server 查询学生基本信息
         try:
-            student = Entity.get_student(verification_req["sid_orig"])
+            student = get_student_profile(verification_req["sid_orig"])
         except Exception as e:
             return handle_exception_with_error_page(e)
 
@@ -357,10 +377,9 @@ def register_by_password_status():
                                                        name=student.name)
 
         return jsonify({"message": "SUCCESS"})
-    elif rpc_result.message in ("PASSWORD_WRONG", "INTERNAL_ERROR", "INVALID_REQUEST_ID"):
-        return jsonify({"message": rpc_result.message})
     else:
-        return jsonify({"message": "NEXT_TIME"})
+        return jsonify({"message"    : message,
+                        "retry_after": get_config().REGISTER_STATUS_POLL_INTERVAL})
 
 
 @user_bp.route('/register/byPassword/success')
@@ -374,7 +393,7 @@ def register_by_password_success():
 def main():
     """用户主页"""
     try:
-        student = Entity.get_student(session[SESSION_CURRENT_USER].sid_orig)
+        student = get_student_profile(session[SESSION_CURRENT_USER].sid_orig)
     except Exception as e:
         return handle_exception_with_error_page(e)
 
@@ -37,3 +37,8 @@ def calendar_dir() -> str:
     if get_env() == "PRODUCTION":
         return "/var/calendar_files/"
     return (current_app.root_path or "") + "/../../calendar_files/"
+
+
+def data_version() -> str:
+    """当前数据版本（api-server 数据最后更新时间），数据更新后以此为键的缓存自动失效"""
+    return str(current_app.config['DATA_LAST_UPDATE_TIME'])
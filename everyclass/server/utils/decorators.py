@@ -1,9 +1,16 @@
 import functools
 
-from flask import render_template, session
+from flask import jsonify, render_template, request, session
 
 from everyclass.server.config import get_config
-from everyclass.server.consts import MSG_400, MSG_NOT_LOGGED_IN, SESSION_CURRENT_USER
+from everyclass.server.consts import MSG_400, MSG_503, MSG_NOT_LOGGED_IN, SESSION_CURRENT_USER
+
+
+def _reject(status: int, message: str, template: str, **context):
+    """装饰器拒绝请求时的响应。JSON API（`api_` 开头的 blueprint）返回 JSON 和对应的状态码，其他请求返回页面"""
+    if request.blueprint and request.blueprint.startswith("api_"):
+        return jsonify({"success": False, "message": message}), status
+    return render_template(template, **context)
 
 
 def disallow_in_maintenance(func):
@@ -15,7 +22,7 @@ def disallow_in_maintenance(func):
     def wrapped(*args, **kwargs):
         config = get_config()
         if config.MAINTENANCE:
-            return render_template('maintenance.html')
+            return _reject(503, MSG_503, 'maintenance.html')
         return func(*args, **kwargs)
 
     return wrapped
@@ -29,7 +36,7 @@ def url_semester_check(func):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         if len(kwargs["url_semester"]) > 11:
-            return render_template('common/error.html', message=MSG_400)
+            return _reject(400, MSG_400, 'common/error.html', message=MSG_400)
         return func(*args, **kwargs)
 
     return wrapped
@@ -43,7 +50,7 @@ def login_required(func):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         if not session.get(SESSION_CURRENT_USER, None):
-            return render_template('common/error.html', message=MSG_NOT_LOGGED_IN, action="login")
+            return _reject(401, MSG_NOT_LOGGED_IN, 'common/error.html', message=MSG_NOT_LOGGED_IN, action="login")
         return func(*args, **kwargs)
 
     return wrapped
@@ -0,0 +1,33 @@
+"""
+Jinja 扩展
+
+`HTMLMinifyExtension` 在模板编译时压缩 HTML 模板源码：删除每行的缩进和空行。模板只在第一次加载时编译，之后渲染不再有额外开销，
+代替在每个响应上运行 htmlmin。保留换行，因此内联的 JavaScript 不受影响；`<pre>` 和 `<textarea>` 中的内容保持原样。
+"""
+import re
+
+from jinja2.ext import Extension
+
+_PRESERVED = re.compile(r'(<(pre|textarea)\b.*?</\2>)', re.IGNORECASE | re.DOTALL)
+_INDENT = re.compile(r'\n\s+')
+
+
+def minify_html(source: str) -> str:
+    """删除 HTML 中每行的缩进和空行，跳过 `<pre>` 和 `<textarea>`"""
+    parts = _PRESERVED.split(source)
+    # split 的结果依次为：普通文本、保留的整段、保留段的标签名、普通文本……
+    result = []
+    for i in range(0, len(parts), 3):
+        result.append(_INDENT.sub('\n', parts[i]))
+        if i + 1 < len(parts):
+            result.append(parts[i + 1])
+    return ''.join(result)
+
+
+class HTMLMinifyExtension(Extension):
+    """编译 HTML 模板前压缩源码"""
+
+    def preprocess(self, source, name, filename=None):
+        if name and name.endswith('.html'):
+            return minify_html(source)
+        return source
@@ -0,0 +1,118 @@
+"""
+整页缓存
+
+首页、关于、帮助等页面，以及匿名访问公开课表时，所有人看到的 HTML 完全相同。这些页面的渲染结果缓存在进程内存和 Redis 中，
+缓存键包含程序版本、数据版本、请求路径和影响页面内容的查询参数，发布新版本或 api-server 数据更新后缓存自动失效。
+
+页面中只有登录状态和 flash 消息与 session 有关，因此已登录或有待显示的 flash 消息时不使用缓存。缓存的响应带有
+`Vary: Cookie`，CDN 不会把未登录时的页面返回给带 cookie 的访问者。
+课表表格等与访问者无关的片段也使用同样的缓存，对所有用户生效。
+"""
+import functools
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+from flask import make_response, request, session
+
+from everyclass.server.config import get_config
+from everyclass.server.consts import SESSION_CURRENT_USER
+from everyclass.server.utils import data_version
+
+_CACHE_RELEVANT_SESSION_KEYS = (SESSION_CURRENT_USER, "_flashes")
+
+_local: "OrderedDict[str, Tuple[float, str, Dict]]" = OrderedDict()
+
+
+def cacheable() -> bool:
+    """当前请求能否使用页面缓存"""
+    return get_config().PAGE_CACHE_ENABLED and request.method == "GET" and \
+        not any(session.get(key, None) for key in _CACHE_RELEVANT_SESSION_KEYS)
+
+
+def key(params: Tuple[str, ...] = ()) -> str:
+    """
+    当前请求的缓存键。只有 params 中列出的查询参数参与缓存键，其他查询参数被忽略，避免任意查询字符串在 Redis 中产生大量缓存
+
+    :param params: 影响页面内容的查询参数
+    """
+    query = urlencode(sorted((name, request.args[name]) for name in params if name in request.args))
+    return "{}:{}:{}?{}".format(get_config().GIT_DESCRIBE, data_version(), request.path, query)
+
+
+def fragment_key(name: str, *parts: str) -> str:
+    """与访问者无关的页面片段的缓存键"""
+    return "{}:{}:fragment:{}:{}".format(get_config().GIT_DESCRIBE, data_version(), name, ":".join(parts))
+
+
+def load(cache_key: str) -> Optional[Tuple[str, Dict]]:
+    """读取缓存，返回 (HTML, 附加信息)，先读进程内缓存，再读 Redis"""
+    from everyclass.server.db.dao import Redis
+
+    item = _local.get(cache_key, None)
+    if item and item[0] > time.time():
+        return item[1], item[2]
+
+    data = Redis.get_page(cache_key)
+    if data is None:
+        return None
+    page = json.loads(data.decode())
+    _set_local(cache_key, page["body"], page["meta"])
+    return page["body"], page["meta"]
+
+
+def store(cache_key: str, body: str, meta: Dict = None) -> None:
+    """写入缓存。meta 为命中缓存时视图函数需要的附加信息"""
+    from everyclass.server.db.dao import Redis
+
+    meta = meta or {}
+    _set_local(cache_key, body, meta)
+    Redis.set_page(cache_key,
+                   json.dumps({"body": body, "meta": meta}, ensure_ascii=False),
+                   get_config().PAGE_CACHE_TTL)
+
+
+def _set_local(cache_key: str, body: str, meta: Dict) -> None:
+    config = get_config()
+    _local[cache_key] = (time.time() + config.PAGE_CACHE_LOCAL_TTL, body, meta)
+    _local.move_to_end(cache_key)
+    while len(_local) > config.PAGE_CACHE_LOCAL_SIZE:
+        _local.popitem(last=False)
+
+
+def with_cache_headers(response, public: bool):
+    """
+    设置 Cache-Control。公开页面允许 CDN 缓存；会写入 session 的页面（如课表）只允许浏览器缓存。
+    响应下发 session cookie 时，session 接口会将 public 改为 private（见 `utils.session`）。
+
+    缓存的页面只适用于未登录且没有 flash 消息的访问者，因此按 Cookie 区分缓存。
+    """
+    visibility = "public" if public else "private"
+    response.headers["Cache-Control"] = "{}, max-age={}".format(visibility, get_config().PAGE_CACHE_MAX_AGE)
+    response.vary.add("Cookie")
+    return response
+
+
+def cached_page(view):
+    """页面缓存装饰器，用于不依赖 session 的公开页面"""
+
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        if not cacheable():
+            return view(*args, **kwargs)
+
+        cache_key = key()
+        cached = load(cache_key)
+        if cached:
+            return with_cache_headers(make_response(cached[0]), public=True)
+
+        response = make_response(view(*args, **kwargs))
+        # session 被修改的响应会下发 cookie，不能缓存
+        if response.status_code == 200 and not session.modified:
+            store(cache_key, response.get_data(as_text=True))
+            with_cache_headers(response, public=True)
+        return response
+
+    return wrapped
@@ -0,0 +1,66 @@
+"""
+密码哈希与校验
+
+PBKDF2 计算是 CPU 密集的。生产环境中每个 uWSGI worker 有多个请求线程，如果每个线程都直接计算，同时登录的人数一多，
+所有线程都会被哈希计算占满。这里将计算放到固定大小的线程池中执行（hashlib 计算时会释放 GIL），同一时间最多只有
+PASSWORD_HASH_WORKERS 个哈希在计算，其余请求排队等待。密码强度检查（zxcvbn）也使用这个线程池。
+哈希算法和迭代次数由 PASSWORD_HASH_METHOD 配置，旧的哈希在用户下次登录时升级。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from everyclass.server.config import get_config
+
+_executor = None
+_pending = 0
+_lock = threading.Lock()
+
+
+def _new_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=get_config().PASSWORD_HASH_WORKERS, thread_name_prefix="password_hash")
+
+
+def init_executor() -> None:
+    """创建线程池。在 fork 后调用，线程池中的线程属于 worker 进程"""
+    global _executor
+    with _lock:
+        _executor = _new_executor()
+
+
+def run_in_executor(func, *args):
+    """在密码计算线程池中执行 func，当前线程等待结果。同时上报排队及计算中的任务数"""
+    from everyclass.server import statsd
+
+    global _executor, _pending
+    if _executor is None:  # 不在 uWSGI 中运行时（开发服务器、命令行）没有 postfork，首次使用时创建
+        with _lock:
+            if _executor is None:
+                _executor = _new_executor()
+
+    with _lock:
+        _pending += 1
+        pending = _pending
+    if statsd:
+        statsd.gauge("password_hash.queue_depth", pending)
+    try:
+        return _executor.submit(func, *args).result()
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def hash_password(password: str) -> str:
+    """使用当前配置的算法计算密码哈希"""
+    return run_in_executor(generate_password_hash, password, get_config().PASSWORD_HASH_METHOD)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """校验密码"""
+    return run_in_executor(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """密码哈希使用的算法或迭代次数与当前配置不同时，需要重新计算"""
+    return password_hash.split("$", 1)[0] != get_config().PASSWORD_HASH_METHOD
@@ -0,0 +1,93 @@
+"""
+密码强度检查
+
+zxcvbn 是纯 Python 实现，计算量较大，而注册页面在用户输入时就会请求强度检查。这里先做低成本的判断：
+- 长度不足 6 位的密码，zxcvbn 的评分不可能达到 2，直接判定为弱密码
+- 用布隆过滤器判断是否为 `simple_passwords` 中记录过的弱密码（仅用于 AJAX 提示，允许极少的误判）。过滤器在 fork 后和
+  定时任务中生成
+- 最近计算过的密码直接返回缓存的评分（以 SHA-256 摘要为键，不在内存中保存明文）
+
+其余情况才在线程池中运行 zxcvbn。
+"""
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from zxcvbn import zxcvbn
+
+from everyclass.server.config import get_config
+from everyclass.server.utils.password import run_in_executor
+
+WEAK_SCORE = 2  # 评分低于此值为弱密码
+
+_CACHE_SIZE = 1024
+_score_cache: "OrderedDict[bytes, int]" = OrderedDict()
+_score_cache_lock = threading.Lock()
+
+
+class BloomFilter:
+    """布隆过滤器，根据容量和误判率计算位数组大小与哈希函数个数"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+_weak_passwords: Optional[BloomFilter] = None
+
+
+def build_weak_passwords() -> None:
+    """
+    从 `simple_passwords` 表生成弱密码布隆过滤器。全表聚合开销较大，只在 fork 后和定时任务中调用，请求中只读取已生成的过滤器
+    """
+    from everyclass.server.db.dao import SimplePassword
+
+    global _weak_passwords
+    config = get_config()
+    bloom = BloomFilter(config.WEAK_PASSWORD_FILTER_CAPACITY, config.WEAK_PASSWORD_FILTER_ERROR_RATE)
+    for password in SimplePassword.distinct_passwords(config.WEAK_PASSWORD_FILTER_CAPACITY):
+        bloom.add(password)
+    _weak_passwords = bloom
+
+
+def score(password: str, exact: bool = False) -> int:
+    """
+    评估密码强度
+
+    :param password: 密码
+    :param exact: 为 True 时不使用布隆过滤器（注册时使用，避免误判）。过滤器尚未生成时也不使用
+    :return: 0-4 的评分，与 zxcvbn 一致。使用布隆过滤器判定为弱密码时返回 1
+    """
+    if len(password) < 6:
+        return 0 if len(password) <= 3 else 1
+    if not exact and _weak_passwords is not None and password in _weak_passwords:
+        return 1
+
+    key = hashlib.sha256(password.encode()).digest()
+    with _score_cache_lock:  # 多个请求线程共用缓存
+        if key in _score_cache:
+            _score_cache.move_to_end(key)
+            return _score_cache[key]
+
+    result = run_in_executor(zxcvbn, password)['score']
+    with _score_cache_lock:
+        _score_cache[key] = result
+        if len(_score_cache) > _CACHE_SIZE:
+            _score_cache.popitem(last=False)
+    return result
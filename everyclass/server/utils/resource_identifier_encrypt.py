@@ -1,11 +1,15 @@
+import functools
 import re
 from binascii import a2b_base64, b2a_base64
-from typing import Text
+from typing import List, Text, Tuple
 
 from Crypto.Cipher import AES
 
 from everyclass.server.config import get_config
 
+_RESOURCE_PATTERN = re.compile(r'^(student|teacher|klass|room);([\s\S]+)$')
+_CACHE_SIZE = get_config().RESOURCE_IDENTIFIER_CACHE_SIZE
+
 
 def _fill_16(text):
     """
@@ -17,6 +21,16 @@ def _fill_16(text):
     return str.encode(text)
 
 
+@functools.lru_cache(maxsize=8)
+def _cipher(aes_key):
+    """
+    获得密钥对应的 AES 对象。ECB 模式的加解密不保存状态，同一个对象可以重复使用
+    :param aes_key: 密钥
+    :return: AES 对象
+    """
+    return AES.new(_fill_16(aes_key), AES.MODE_ECB)
+
+
 def _aes_decrypt(aes_key, aes_text) -> Text:
     """
     使用密钥解密文本信息，将会自动填充空白字符
@@ -24,8 +38,8 @@ def _aes_decrypt(aes_key, aes_text) -> Text:
     :param aes_text: 需要解密的文本
     :return: 经过解密的数据
     """
-    # 初始化解码器
-    cipher = AES.new(_fill_16(aes_key), AES.MODE_ECB)
+    # 获得解码器
+    cipher = _cipher(aes_key)
     # 优先逆向解密十六进制为bytes
     converted = a2b_base64(aes_text.replace('-', '/').replace("%3D", "=").encode())
     # 使用aes解密密文
@@ -41,8 +55,8 @@ def _aes_encrypt(aes_key, aes_text) -> Text:
     :param aes_text: 需要加密的文本
     :return: 经过加密的数据
     """
-    # 初始化加密器
-    cipher = AES.new(_fill_16(aes_key), AES.MODE_ECB)
+    # 获得加密器
+    cipher = _cipher(aes_key)
     # 先进行aes加密
     aes_encrypted = cipher.encrypt(_fill_16(aes_text))
     # 使用十六进制转成字符串形式
@@ -65,9 +79,31 @@ def encrypt(resource_type: str, data: str, encryption_key: str = None) -> Text:
     if not encryption_key:
         encryption_key = get_config().RESOURCE_IDENTIFIER_ENCRYPTION_KEY
 
+    return _encrypt_cached(encryption_key, resource_type, data)
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _encrypt_cached(encryption_key: str, resource_type: str, data: str) -> Text:
     return _aes_encrypt(encryption_key, "%s;%s" % (resource_type, data))
 
 
+def encrypt_many(resource_type: str, data: List[str], encryption_key: str = None) -> List[Text]:
+    """
+    批量加密资源标识符，用于渲染列表
+
+    :param resource_type: student、teacher、klass、room
+    :param data: 资源标识符列表
+    :param encryption_key: 加密使用的 key
+    :return: 加密后的资源标识符列表，顺序与 data 一致
+    """
+    if resource_type not in ('student', 'teacher', 'klass', 'room'):
+        raise ValueError("resource_type not valid")
+    if not encryption_key:
+        encryption_key = get_config().RESOURCE_IDENTIFIER_ENCRYPTION_KEY
+
+    return [_encrypt_cached(encryption_key, resource_type, item) for item in data]
+
+
 def decrypt(data: str, encryption_key: str = None, resource_type: str = None):
     """
     解密资源标识符
@@ -80,12 +116,33 @@ def decrypt(data: str, encryption_key: str = None, resource_type: str = None):
     if not encryption_key:
         encryption_key = get_config().RESOURCE_IDENTIFIER_ENCRYPTION_KEY
 
+    rtype, identifier = _decrypt_cached(encryption_key, data)
+    if resource_type and rtype != resource_type:
+        raise ValueError('Resource type not correspond')
+    return rtype, identifier
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _decrypt_cached(encryption_key: str, data: str) -> Tuple[str, str]:
+    """解密并校验资源标识符。解密失败时抛出 ValueError，失败的结果不会被缓存"""
     data = _aes_decrypt(encryption_key, data)
 
-    group = re.match(r'^(student|teacher|klass|room);([\s\S]+)$', data)  # 通过正则校验确定数据的正确性
+    group = _RESOURCE_PATTERN.match(data)  # 通过正则校验确定数据的正确性
     if group is None:
         raise ValueError('Decrypted data is invalid: %s' % data)
-    else:
-        if resource_type and group.group(1) != resource_type:
-            raise ValueError('Resource type not correspond')
-        return group.group(1), group.group(2)
+    return group.group(1), group.group(2)
+
+
+def decrypt_many(data: List[str], encryption_key: str = None, resource_type: str = None) -> List[Tuple[str, str]]:
+    """
+    批量解密资源标识符
+
+    :param data: 加密后的字符串列表
+    :param encryption_key: 可选的 key
+    :param resource_type: 验证资源类型（student、teacher、klass、room）
+    :return: (资源类型, 资源标识符) 列表，顺序与 data 一致
+    """
+    if not encryption_key:
+        encryption_key = get_config().RESOURCE_IDENTIFIER_ENCRYPTION_KEY
+
+    return [decrypt(item, encryption_key=encryption_key, resource_type=resource_type) for item in data]
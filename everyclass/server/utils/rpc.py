@@ -1,11 +1,15 @@
 from typing import Text
 
+from ddtrace import tracer
 from flask import g, render_template
 
 from everyclass.common.flask import plugin_available
 from everyclass.rpc import RpcBadRequest, RpcClientException, RpcResourceNotFound, RpcServerException, \
     RpcServerNotAvailable, RpcTimeout
+from everyclass.rpc.entity import Entity
 from everyclass.server import logger, sentry
+from everyclass.server.models import StudentProfile
+from everyclass.server.utils import data_version
 
 
 def _error_page(message: str, sentry_capture: bool = False, log: str = None):
@@ -42,3 +46,48 @@ def handle_exception_with_error_page(e: Exception) -> Text:
         return _error_page(MSG_INTERNAL_ERROR, sentry_capture=True)
     else:
         return _error_page(MSG_INTERNAL_ERROR, sentry_capture=True)
+
+
+def handle_exception_with_json(e: Exception):
+    """处理抛出的异常，返回 JSON 错误信息和对应的状态码，供 API 使用
+    """
+    from flask import jsonify
+    from everyclass.server.consts import MSG_TIMEOUT, MSG_404, MSG_400, MSG_INTERNAL_ERROR, MSG_503
+
+    if isinstance(e, RpcTimeout):
+        message, status = MSG_TIMEOUT, 504
+    elif isinstance(e, RpcResourceNotFound):
+        message, status = MSG_404, 404
+    elif isinstance(e, (RpcBadRequest, RpcClientException)):
+        message, status = MSG_400, 400
+    elif isinstance(e, RpcServerNotAvailable):
+        message, status = MSG_503, 503
+    else:
+        message, status = MSG_INTERNAL_ERROR, 500
+    if status >= 500 and plugin_available("sentry"):
+        sentry.captureException()
+    return jsonify({"success": False, "message": message}), status
+
+
+def get_student_profile(student_id: str) -> StudentProfile:
+    """
+    获得学生基本信息，优先读取 Redis 缓存。缓存键包含数据版本，api-server 数据更新后缓存自动失效。
+
+    :raises: 与 `Entity.get_student` 相同的 RPC 异常
+    """
+    from everyclass.server.db.dao import Redis
+
+    version = data_version()
+    student = Redis.get_student(student_id, version)
+    if student:
+        return student
+
+    with tracer.trace('rpc_get_student'):
+        result = Entity.get_student(student_id)
+    student = StudentProfile(student_id=result.student_id,
+                             student_id_encoded=result.student_id_encoded,
+                             name=result.name,
+                             klass=result.klass,
+                             semesters=list(result.semesters))
+    Redis.set_student(student, version)
+    return student
@@ -2,12 +2,18 @@
 import _pickle
 import base64
 import pickle
+import secrets
+import time
 import zlib
+from typing import Optional
 
 from Crypto.Cipher import AES
 from flask.sessions import SessionInterface, SessionMixin
 from werkzeug.datastructures import CallbackDict
 
+from everyclass.server.consts import SESSION_CURRENT_USER, SESSION_ISSUED_AT
+from everyclass.server.utils import session_codec
+
 
 class EncryptedSession(CallbackDict, SessionMixin):
     def __init__(self, initial=None):
@@ -18,6 +24,20 @@ class EncryptedSession(CallbackDict, SessionMixin):
         self.modified = False
 
 
+def _no_shared_cache(response) -> None:
+    """下发 cookie 的响应不允许 CDN 等共享缓存保存，否则其他访问者会拿到同一个 session cookie"""
+    cache_control = response.headers.get("Cache-Control", "")
+    if cache_control.startswith("public"):
+        response.headers["Cache-Control"] = "private" + cache_control[len("public"):]
+
+
+def _assign_lazy_user_id(app, session) -> None:
+    """延迟分配模式：只在 session 确实需要保存时才分配用户 ID"""
+    if app.config.get('LAZY_USER_ID', False) and not session.get('user_id', None):
+        from everyclass.server.db.dao import new_user_id_sequence
+        session['user_id'] = new_user_id_sequence()
+
+
 class EncryptedSessionInterface(SessionInterface):
     session_class = EncryptedSession
     compress_threshold = 1024
@@ -39,7 +59,7 @@ class EncryptedSessionInterface(SessionInterface):
         # Get the crypto key
         crypto_key = app.config['SESSION_CRYPTO_KEY'] if 'SESSION_CRYPTO_KEY' in app.config else app.crypto_key
 
-        # Split the session cookie : <z|u>.<base64 cipher text>.<base64 mac>.<base64 nonce>
+        # Split the session cookie : <c|cz|z|u>.<base64 cipher text>.<base64 mac>.<base64 nonce>
         itup = session_cookie.split(".")
         if len(itup) != 4:
             return self.session_class()  # Session cookie not in the right format
@@ -47,7 +67,7 @@ class EncryptedSessionInterface(SessionInterface):
         try:
 
             # Compressed data?
-            if itup[0] == 'z':  # session cookie for compressed data starts with "z."
+            if itup[0] in ('z', 'cz'):  # session cookie for compressed data starts with "z." or "cz."
                 is_compressed = True
             else:
                 is_compressed = False
@@ -64,11 +84,14 @@ class EncryptedSessionInterface(SessionInterface):
             # Convert back to a dict and pass that onto the session
             if is_compressed:
                 data = zlib.decompress(data)
-            session_dict = pickle.loads(data)
+            if itup[0].startswith('c'):  # 紧凑编码
+                session_dict = session_codec.decode(data)
+            else:  # 旧版本的 pickle 编码
+                session_dict = pickle.loads(data)
 
             return self.session_class(session_dict)
 
-        except (ValueError, _pickle.UnpicklingError, pickle.UnpicklingError):
+        except (ValueError, zlib.error, _pickle.UnpicklingError, pickle.UnpicklingError):
             return self.session_class()
 
     def save_session(self, app, session, response):
@@ -84,16 +107,27 @@ class EncryptedSessionInterface(SessionInterface):
         if not session:
             if session.modified:
                 response.delete_cookie(app.session_cookie_name, domain=domain)
+                _no_shared_cache(response)
             return
+
+        _assign_lazy_user_id(app, session)
+
+        # session 没有修改且 cookie 未到刷新时间，不重新加密和下发 cookie
+        now = int(time.time())
+        if not session.modified and \
+                now - session.get(SESSION_ISSUED_AT, 0) < app.config.get('SESSION_COOKIE_REFRESH_INTERVAL', 0):
+            return
+        session[SESSION_ISSUED_AT] = now
+
         expires = self.get_expiration_time(app, session)
 
         # Decide whether to compress
-        bdict = pickle.dumps(dict(session))
+        bdict = session_codec.encode(dict(session))
         if len(bdict) > self.compress_threshold:
-            prefix = "z"  # session cookie for compressed data starts with "z."
+            prefix = "cz"  # session cookie for compressed data starts with "cz."
             bdict = zlib.compress(bdict)
         else:
-            prefix = "u"  # session cookie for uncompressed data starts with "u."
+            prefix = "c"  # session cookie for uncompressed data starts with "c."
 
         # Get the crypto key
         crypto_key = app.config['SESSION_CRYPTO_KEY'] if 'SESSION_CRYPTO_KEY' in app.config else app.crypto_key
@@ -108,7 +142,7 @@ class EncryptedSessionInterface(SessionInterface):
         b64_mac = base64.b64encode(mac)
         b64_nonce = base64.b64encode(nonce)
 
-        # Create the session cookie as <u|z>.<base64 cipher text>.<base64 mac>.<base64 nonce>
+        # Create the session cookie as <c|cz>.<base64 cipher text>.<base64 mac>.<base64 nonce>
         tup = [prefix, b64_ciphertext.decode(), b64_mac.decode(), b64_nonce.decode()]
         session_cookie = ".".join(tup)
 
@@ -116,3 +150,116 @@ class EncryptedSessionInterface(SessionInterface):
         response.set_cookie(self.session_cookie_name, session_cookie,
                             expires=expires, httponly=True,
                             domain=domain)
+        _no_shared_cache(response)
+
+
+class RedisSession(EncryptedSession):
+    """
+    服务端 session，第一次读写时才从 Redis 加载。不使用 session 的请求不会访问 Redis。
+    """
+
+    def __init__(self, session_id: str = None, ttl: int = 0):
+        super().__init__()
+        self.session_id = session_id
+        self.ttl = ttl
+        self.remaining_ttl = 0  # 加载时 Redis 中剩余的过期时间
+        self.loaded_user = None  # 加载时的登录用户学号，登录用户变化时需要更换 session ID
+        self.loaded = session_id is None  # 新 session 不需要加载
+
+    def _load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+
+        from everyclass.server.db.dao import Redis
+        data, self.remaining_ttl = Redis.load_session(self.session_id)
+        if not data:
+            self.session_id = None  # session 已过期或被注销，保存时分配新的 ID
+            return
+        try:
+            dict.update(self, session_codec.decode(data))  # 不触发 on_update
+        except ValueError:
+            pass
+        self.loaded_user = _user_of(self)
+
+
+def _user_of(session) -> Optional[str]:
+    """session 中登录用户的学号，未登录时为 None"""
+    current_user = dict.get(session, SESSION_CURRENT_USER, None)
+    return current_user.sid_orig if current_user else None
+
+
+def _loading(name: str):
+    method = getattr(EncryptedSession, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ("__getitem__", "__setitem__", "__delitem__", "__contains__", "__iter__", "__len__", "__eq__",
+              "__repr__", "get", "keys", "values", "items", "copy", "pop", "popitem", "setdefault", "update",
+              "clear"):
+    setattr(RedisSession, _name, _loading(_name))
+
+
+class RedisSessionInterface(SessionInterface):
+    """
+    服务端 session：cookie 中只保存随机生成的 session ID，session 内容使用紧凑编码存储在 Redis 中，访问时如果剩余时间不足
+    则延长过期时间。空的 session 不保存。需要注销某个用户的所有 session 时，使用 `Redis.revoke_user_sessions`。
+    """
+    session_class = RedisSession
+    session_cookie_name = "s_session"
+
+    def open_session(self, app, request):
+        return self.session_class(request.cookies.get(self.session_cookie_name) or None,
+                                  app.config['SESSION_REDIS_TTL'])
+
+    def save_session(self, app, session, response):
+        from everyclass.server.db.dao import Redis
+
+        if not session.loaded:  # 本次请求没有使用 session
+            return
+
+        domain = self.get_cookie_domain(app)
+        if not session:
+            if session.session_id:
+                Redis.delete_session(session.session_id)
+                response.delete_cookie(self.session_cookie_name, domain=domain)
+                _no_shared_cache(response)
+            return
+
+        _assign_lazy_user_id(app, session)
+
+        # 只有自动分配的用户 ID 的 session（如爬虫的请求）使用较短的过期时间
+        ttl = app.config['SESSION_REDIS_ANONYMOUS_TTL'] if set(session.keys()) <= {'user_id'} else session.ttl
+        if not session.modified:
+            # 未修改的 session 不必每次都写 Redis，剩余时间不足时才延长过期时间
+            if session.session_id and \
+                    ttl - session.remaining_ttl > min(app.config['SESSION_COOKIE_REFRESH_INTERVAL'], ttl // 2):
+                Redis.touch_session(session.session_id, ttl)
+            return
+
+        current_user = _user_of(session)
+        if session.session_id and current_user != session.loaded_user:
+            # 登录、注册或注销后更换 session ID，防止登录前的 session ID 被他人预先设置（session 固定攻击）
+            Redis.delete_session(session.session_id)
+            session.session_id = None
+
+        is_new = session.session_id is None
+        if is_new:
+            session.session_id = secrets.token_urlsafe(32)
+
+        Redis.save_session(session.session_id,
+                           session_codec.encode(dict(session)),
+                           ttl,
+                           sid_orig=current_user)
+
+        if is_new:
+            response.set_cookie(self.session_cookie_name, session.session_id,
+                                expires=self.get_expiration_time(app, session), httponly=True,
+                                domain=domain)
+            _no_shared_cache(response)
@@ -0,0 +1,133 @@
+"""
+session 的紧凑二进制编码
+
+pickle 会把键名、`StudentSession` 的类路径和字段名都写进 cookie。这里为 `consts.py` 中定义的 session 键分配固定的单字节标签，
+按字段类型紧凑编码；学生的加密学号可由原始学号计算得到，一般不需要写入。其他未知的键仍然使用 pickle 编码单个值。
+
+格式：版本号（1 字节），之后是若干个 <标签><值>。
+"""
+import math
+import pickle
+from typing import Dict
+
+from everyclass.server.consts import SESSION_CURRENT_USER, SESSION_EMAIL_VER_REQ_ID, SESSION_ISSUED_AT, \
+    SESSION_LAST_VIEWED_STUDENT, SESSION_PWD_VER_REQ_ID, SESSION_READ_PRIMARY_UNTIL, SESSION_STUDENT_TO_REGISTER
+from everyclass.server.models import StudentSession
+from everyclass.server.utils.resource_identifier_encrypt import encrypt
+
+VERSION = 1
+
+_TYPE_INT = 0
+_TYPE_STR = 1
+_TYPE_STUDENT = 2
+
+# key -> (tag, type)，标签一旦分配不可修改
+_KNOWN_KEYS = {
+    "user_id"                  : (1, _TYPE_INT),
+    SESSION_CURRENT_USER       : (2, _TYPE_STUDENT),
+    SESSION_LAST_VIEWED_STUDENT: (3, _TYPE_STUDENT),
+    SESSION_STUDENT_TO_REGISTER: (4, _TYPE_STUDENT),
+    SESSION_PWD_VER_REQ_ID     : (5, _TYPE_STR),
+    SESSION_EMAIL_VER_REQ_ID   : (6, _TYPE_STR),
+    SESSION_ISSUED_AT          : (7, _TYPE_INT),
+    SESSION_READ_PRIMARY_UNTIL : (8, _TYPE_INT),
+}
+_TAGS = {tag: (key, typ) for key, (tag, typ) in _KNOWN_KEYS.items()}
+_TAG_OTHER = 0xFF  # 未知的键：<键名><pickle 后的值>
+
+
+def _write_varint(buf: bytearray, value: int) -> None:
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            return
+
+
+def _read_varint(data: bytes, pos: int):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_bytes(buf: bytearray, value: bytes) -> None:
+    _write_varint(buf, len(value))
+    buf.extend(value)
+
+
+def _read_bytes(data: bytes, pos: int):
+    length, pos = _read_varint(data, pos)
+    return data[pos:pos + length], pos + length
+
+
+def _write_str(buf: bytearray, value: str) -> None:
+    _write_bytes(buf, value.encode())
+
+
+def _read_str(data: bytes, pos: int):
+    value, pos = _read_bytes(data, pos)
+    return value.decode(), pos
+
+
+def encode(session: Dict) -> bytes:
+    """编码 session 字典"""
+    buf = bytearray([VERSION])
+    for key, value in session.items():
+        tag, typ = _KNOWN_KEYS.get(key, (None, None))
+        if typ == _TYPE_INT and isinstance(value, (int, float)) and value >= 0:
+            buf.append(tag)
+            _write_varint(buf, math.ceil(value))  # 时间戳向上取整到秒
+        elif typ == _TYPE_STR and isinstance(value, str):
+            buf.append(tag)
+            _write_str(buf, value)
+        elif typ == _TYPE_STUDENT and isinstance(value, StudentSession):
+            buf.append(tag)
+            _write_str(buf, value.sid_orig)
+            _write_str(buf, value.name)
+            # 加密学号与计算结果一致时不写入
+            _write_str(buf, "" if value.sid == encrypt("student", value.sid_orig) else value.sid)
+        else:
+            buf.append(_TAG_OTHER)
+            _write_str(buf, key)
+            _write_bytes(buf, pickle.dumps(value))
+    return bytes(buf)
+
+
+def decode(data: bytes) -> Dict:
+    """解码 session，数据格式不正确时抛出 ValueError"""
+    if not data or data[0] != VERSION:
+        raise ValueError("Unknown session encoding version")
+
+    session = {}
+    pos = 1
+    try:
+        while pos < len(data):
+            tag = data[pos]
+            pos += 1
+            if tag == _TAG_OTHER:
+                key, pos = _read_str(data, pos)
+                value, pos = _read_bytes(data, pos)
+                session[key] = pickle.loads(value)
+                continue
+
+            key, typ = _TAGS[tag]
+            if typ == _TYPE_INT:
+                session[key], pos = _read_varint(data, pos)
+            elif typ == _TYPE_STR:
+                session[key], pos = _read_str(data, pos)
+            else:
+                sid_orig, pos = _read_str(data, pos)
+                name, pos = _read_str(data, pos)
+                sid, pos = _read_str(data, pos)
+                session[key] = StudentSession(sid_orig=sid_orig, sid=sid or encrypt("student", sid_orig), name=name)
+    except (IndexError, KeyError, UnicodeDecodeError, pickle.UnpicklingError) as e:
+        raise ValueError("Malformed session data") from e
+    return session
@@ -5,11 +5,13 @@ from flask import Blueprint, Response, jsonify, render_template, request
 
 from everyclass.server.config import get_config
 from everyclass.server.consts import MSG_404
+from everyclass.server.utils.page_cache import cached_page
 
 main_blueprint = Blueprint('main', __name__)
 
 
 @main_blueprint.route('/')
+@cached_page
 def main():
     """首页"""
     return render_template('common/index.html')
@@ -23,12 +25,14 @@ def test():
 
 
 @main_blueprint.route('/about')
+@cached_page
 def about():
     """关于页面"""
     return render_template('common/about.html')
 
 
 @main_blueprint.route('/guide')
+@cached_page
 def guide():
     """帮助页面"""
     return render_template('common/guide.html')
@@ -41,6 +45,7 @@ def testing():
 
 
 @main_blueprint.route('/donate')
+@cached_page
 def donate():
     """点击发送邮件后的捐助页面"""
     return render_template('common/donate.html')
@@ -89,6 +94,24 @@ def exit_maintenance():
                 {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
 
+@main_blueprint.route("/_internal/pools")
+def pool_status():
+    """数据库连接池使用情况"""
+    from everyclass.server.db.metrics import pool_stats
+
+    config = get_config()
+    auth = request.authorization
+    if auth \
+            and auth.username in config.MAINTENANCE_CREDENTIALS \
+            and config.MAINTENANCE_CREDENTIALS[auth.username] == auth.password:
+        return jsonify(pool_stats())
+    else:
+        return Response(
+                'Could not verify your access level for that URL.\n'
+                'You have to login with proper credentials', 401,
+                {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+
 @main_blueprint.app_errorhandler(404)
 def page_not_found(error):
     # 404 errors are never handled on the blueprint level
@@ -70,3 +70,72 @@ class ResourceIdentifierEncryptTest(unittest.TestCase):
         from everyclass.server.utils.resource_identifier_encrypt import decrypt
         for tp, data, encrypted in self.cases:
             self.assertTrue(decrypt(encrypted, encryption_key=self.key, resource_type=tp) == (tp, data))
+
+    def test_bulk(self):
+        from everyclass.server.utils.resource_identifier_encrypt import decrypt_many, encrypt_many
+        for tp, data, encrypted in self.cases:
+            self.assertEqual(encrypt_many(tp, [data, data], encryption_key=self.key), [encrypted, encrypted])
+            self.assertEqual(decrypt_many([encrypted], encryption_key=self.key, resource_type=tp), [(tp, data)])
+
+
+class SessionCodecTest(unittest.TestCase):
+    """everyclass/server/utils/session_codec.py"""
+
+    def test_round_trip(self):
+        from everyclass.server.consts import SESSION_CURRENT_USER, SESSION_ISSUED_AT, SESSION_PWD_VER_REQ_ID
+        from everyclass.server.models import StudentSession
+        from everyclass.server.utils import session_codec
+
+        session = {"user_id"             : 10000001,
+                   SESSION_CURRENT_USER  : StudentSession(sid_orig="3901160407", sid="not-derived", name="张三"),
+                   SESSION_PWD_VER_REQ_ID: "2b1c7f0e-0c8f-4a8c-9f5e-3c1e0d2a6b7f",
+                   SESSION_ISSUED_AT     : 1571500000,
+                   "_flashes"            : [("message", "hello")]}
+        self.assertEqual(session_codec.decode(session_codec.encode(session)), session)
+
+    def test_malformed(self):
+        from everyclass.server.utils import session_codec
+
+        with self.assertRaises(ValueError):
+            session_codec.decode(b"\x01\x02\x05")
+        with self.assertRaises(ValueError):
+            session_codec.decode(b"\x80\x03}q\x00.")
+
+
+class PasswordStrengthTest(unittest.TestCase):
+    """everyclass/server/utils/password_strength.py"""
+
+    def test_bloom_filter(self):
+        from everyclass.server.utils.password_strength import BloomFilter
+
+        bloom = BloomFilter(1000, 0.001)
+        for password in ("123456", "password", "qwerty123"):
+            bloom.add(password)
+        self.assertIn("password", bloom)
+        self.assertNotIn("Tr0ub4dor&3-horse-staple", bloom)
+
+    def test_short_password(self):
+        from everyclass.server.utils.password_strength import WEAK_SCORE, score
+
+        self.assertLess(score("abc12", exact=True), WEAK_SCORE)
+
+
+class HTMLMinifyTest(unittest.TestCase):
+    """everyclass/server/utils/jinja.py"""
+
+    def test_minify_html(self):
+        from everyclass.server.utils.jinja import minify_html
+
+        source = "<div>\n    <p>{{ name }}</p>\n\n    <pre>\n  keep\n</pre>\n    <script>\n        a()\n    </script>\n"
+        self.assertEqual(minify_html(source),
+                         "<div>\n<p>{{ name }}</p>\n<pre>\n  keep\n</pre>\n<script>\na()\n</script>\n")
+
+
+class TimetableGridTest(unittest.TestCase):
+    """everyclass/server/models.py"""
+
+    def test_week_mask(self):
+        from everyclass.server.models import mask_to_weeks, weeks_to_mask
+
+        self.assertEqual(weeks_to_mask([1, 3, 4]), 0b1101)
+        self.assertEqual(mask_to_weeks(weeks_to_mask([2, 5, 16])), [2, 5, 16])